@@ -0,0 +1,114 @@
+"""An in-process LDAP stand-in for benchmarks.
+
+`install()` makes `ldap.initialize` return `FakeLDAPObject`s, which accept
+binds of any user of the domain with a fixed password and answer user
+searches with a small entry, after `latency` seconds. If python-ldap is not
+installed, a module holding the parts of its API used by xsvds is
+registered as `ldap` instead, so that benchmarks run without it.
+
+Must be called before `vds` modules are imported.
+"""
+import collections
+import sys
+import threading
+import time
+import types
+
+calls = collections.Counter()  # operation -> number of calls
+_lock = threading.Lock()
+
+
+class _Options(object):
+    latency = 0.0
+    password = 'password'
+
+
+def _count(op):
+    with _lock:
+        calls[op] += 1
+    if _Options.latency:
+        time.sleep(_Options.latency)
+
+
+def _api():
+    try:
+        import ldap
+        import ldap.filter
+        return ldap
+    except ImportError:
+        pass
+
+    ldap = types.ModuleType('ldap')
+    ldap.OPT_REFERRALS, ldap.OPT_NETWORK_TIMEOUT, ldap.OPT_TIMEOUT = 0x08, 0x5005, 0x5002
+    ldap.SCOPE_BASE, ldap.SCOPE_ONELEVEL, ldap.SCOPE_SUBTREE = 0, 1, 2
+
+    class LDAPError(Exception):
+        pass
+    ldap.LDAPError = LDAPError
+    for name in ('CONNECT_ERROR', 'SERVER_DOWN', 'TIMEOUT', 'INVALID_CREDENTIALS', 'SIZELIMIT_EXCEEDED'):
+        setattr(ldap, name, type(name, (LDAPError,), {}))
+
+    ldap_filter = types.ModuleType('ldap.filter')
+    def escape_filter_chars(value):
+        for char, escaped in (('\\', r'\5c'), ('*', r'\2a'), ('(', r'\28'), (')', r'\29'), ('\x00', r'\00')):
+            value = value.replace(char, escaped)
+        return value
+    ldap_filter.escape_filter_chars = escape_filter_chars
+    ldap.filter = ldap_filter
+    sys.modules['ldap'] = ldap
+    sys.modules['ldap.filter'] = ldap_filter
+    return ldap
+
+
+class FakeLDAPObject(object):
+    """A connection to the fake directory."""
+
+    def __init__(self, ldap, uri):
+        self._ldap = ldap
+        self.uri = uri
+        self.who = None
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        _count('bind')
+        if who and cred != _Options.password:
+            raise self._ldap.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+        self.who = who
+
+    def search_ext_s(self, base, scope, filterstr, attrlist=None, timeout=-1, sizelimit=0):
+        _count('search')
+        principal = filterstr.split('=', 1)[1]
+        attrs = {
+            'cn': [principal.split('@')[0]],
+            'displayName': [principal.split('@')[0].title()],
+            'mail': [principal],
+            'userPrincipalName': [principal],
+            'memberOf': ['CN=Desktop Users,CN=Users,' + base],
+        }
+        if attrlist is not None:
+            attrs = dict((k, v) for k, v in attrs.items() if k in attrlist)
+        return [('CN={},CN=Users,{}'.format(principal.split('@')[0], base), attrs)]
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        return self.search_ext_s(base, scope, filterstr, attrlist)
+
+    def unbind_s(self):
+        _count('unbind')
+
+
+def install(latency=0.0, password='password'):
+    """Route `ldap.initialize` to the fake directory.
+
+    Args:
+        latency (float): seconds each bind and search is delayed.
+        password (str): password accepted for every user.
+    """
+    _Options.latency = latency
+    _Options.password = password
+    ldap = _api()
+    def initialize(uri, *args, **kwargs):
+        _count('connect')
+        return FakeLDAPObject(ldap, uri)
+    ldap.initialize = initialize
@@ -0,0 +1,305 @@
+"""A fake XAPI XML-RPC server for benchmarks.
+
+Serves a pool of `vms` VMs owned round-robin by `owners` users, implementing
+the calls xsvds makes: `session`, `pool`, `host`, `VM`, `VM_guest_metrics`,
+`Async.VM.start`, `task` and `event.from`. Every call can be delayed by
+`latency` seconds, and VM starts take `boot_time` seconds.
+
+Example:
+
+    server = FakeXapi(vms=1000, owners=100, latency=0.002)
+    address = server.start()   # 'host:port'
+    ...
+    print server.calls         # method -> number of calls
+
+Run as a script, the server is started in a process of its own and prints
+its address. `bench.calls` and `bench.reset` then read and reset the call
+counts over XML-RPC.
+"""
+import argparse
+import collections
+import sys
+import threading
+import time
+import uuid
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+OWNER_FIELD = 'XenCenter.CustomFields.owner'
+
+
+class _Handler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as xapi
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _ok(value):
+    return {'Status': 'Success', 'Value': value}
+
+
+def _failure(*description):
+    return {'Status': 'Failure', 'ErrorDescription': list(description)}
+
+
+class FakeXapi(object):
+    """The fake pool and its XML-RPC server.
+
+    Attributes:
+        calls (Counter): method name -> number of calls.
+    """
+
+    def __init__(self, vms=100, owners=10, latency=0.0, boot_time=1.0, vms_per_host=50,
+                 running_ratio=0.5):
+        """
+        Args:
+            vms (int): number of VMs.
+            owners (int): number of users owning them, named `user0`, `user1`...
+            latency (float): seconds each call is delayed.
+            boot_time (float): seconds a VM start takes.
+            vms_per_host (int): VMs per home host.
+            running_ratio (float): share of the VMs running initially.
+        """
+        self.latency = latency
+        self.boot_time = boot_time
+        self.calls = collections.Counter()
+        self._lock = threading.Condition()
+        self._events = []  # event log, event.from tokens are indices in it
+        self._vms = {}
+        self._metrics = {}
+        self._by_uuid = {}
+        self._tasks = {}
+        running = int(vms * running_ratio)
+        for i in range(vms):
+            ref, mref = 'OpaqueRef:vm-{}'.format(i), 'OpaqueRef:vgm-{}'.format(i)
+            self._vms[ref] = {
+                'uuid': 'vm-{:06d}'.format(i),
+                'name_label': 'desktop-{}'.format(i),
+                'power_state': 'Running' if i >= vms - running else 'Halted',
+                'guest_metrics': mref,
+                'other_config': {OWNER_FIELD: 'user{}'.format(i % owners)},
+                'affinity': 'OpaqueRef:host-{}'.format(i // vms_per_host),
+                'resident_on': 'OpaqueRef:NULL',
+                'is_a_template': False,
+                'is_control_domain': False,
+            }
+            self._metrics[mref] = {
+                'networks': {'0/ip': '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)},
+                'os_version': {'distro': 'windows', 'name': 'Windows 10'},
+            }
+            self._by_uuid[self._vms[ref]['uuid']] = ref
+        self._server = None
+
+    def start(self):
+        """Serve on an ephemeral port of localhost in a daemon thread.
+
+        Returns:
+            str: 'host:port' of the server.
+        """
+        self._server = _Server(('127.0.0.1', 0), requestHandler=_Handler,
+                               logRequests=False, allow_none=True)
+        self._server.register_instance(self)
+        thread = threading.Thread(target=self._server.serve_forever, name='fake-xapi')
+        thread.daemon = True
+        thread.start()
+        return '{}:{}'.format(*self._server.server_address)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _emit(self, cls, operation, ref, snapshot):
+        # callers hold the lock
+        self._events.append({'id': str(len(self._events)), 'class': cls, 'operation': operation,
+                             'ref': ref, 'snapshot': dict(snapshot), 'timestamp': str(time.time())})
+        self._lock.notify_all()
+
+    def _dispatch(self, method, params):
+        if self.latency and method != 'event.from':
+            time.sleep(self.latency)
+        handler = getattr(self, '_' + method.replace('.', '_'), None)
+        with self._lock:
+            if method.startswith('bench.'):
+                return handler(*params)
+            self.calls[method] += 1
+            if handler is None:
+                return _failure('MESSAGE_METHOD_UNKNOWN', method)
+            return handler(*params[1:]) if not method.startswith('session.') else handler(*params)
+
+    # benchmark control
+
+    def _bench_calls(self):
+        return dict(self.calls)
+
+    def _bench_reset(self):
+        self.calls.clear()
+        return True
+
+    # session, pool, host
+
+    def _session_login_with_password(self, *args):
+        return _ok('OpaqueRef:session-{}'.format(uuid.uuid4()))
+
+    def _session_logout(self, *args):
+        return _ok('')
+
+    def _pool_get_all(self):
+        return _ok(['OpaqueRef:pool'])
+
+    def _pool_get_master(self, pool):
+        return _ok('OpaqueRef:host-0')
+
+    def _host_get_API_version_major(self, host):
+        return _ok('2')
+
+    def _host_get_API_version_minor(self, host):
+        return _ok('5')
+
+    # VM and VM_guest_metrics
+
+    def _VM_get_all(self):
+        return _ok(list(self._vms))
+
+    def _VM_get_all_records(self):
+        return _ok(self._vms)
+
+    def _VM_get_by_uuid(self, vm_uuid):
+        ref = self._by_uuid.get(vm_uuid)
+        if ref is None:
+            return _failure('UUID_INVALID', 'VM', vm_uuid)
+        return _ok(ref)
+
+    def _vm_field(self, ref, field):
+        if ref not in self._vms:
+            return _failure('HANDLE_INVALID', 'VM', ref)
+        return _ok(self._vms[ref][field])
+
+    def _VM_get_record(self, ref):
+        if ref not in self._vms:
+            return _failure('HANDLE_INVALID', 'VM', ref)
+        return _ok(self._vms[ref])
+
+    def _VM_get_other_config(self, ref):
+        return self._vm_field(ref, 'other_config')
+
+    def _VM_get_power_state(self, ref):
+        return self._vm_field(ref, 'power_state')
+
+    def _VM_get_affinity(self, ref):
+        return self._vm_field(ref, 'affinity')
+
+    def _VM_guest_metrics_get_record(self, ref):
+        if ref not in self._metrics:
+            return _failure('HANDLE_INVALID', 'VM_guest_metrics', ref)
+        return _ok(self._metrics[ref])
+
+    def _VM_guest_metrics_get_all_records(self):
+        return _ok(self._metrics)
+
+    def _set_power_state(self, ref, state):
+        self._vms[ref]['power_state'] = state
+        self._emit('VM', 'mod', ref, self._vms[ref])
+
+    def _VM_start(self, ref, paused=False, force=False):
+        vm = self._vms.get(ref)
+        if vm is None:
+            return _failure('HANDLE_INVALID', 'VM', ref)
+        if vm['power_state'] != 'Halted':
+            return _failure('VM_BAD_POWER_STATE', ref, 'halted', vm['power_state'].lower())
+        self._set_power_state(ref, 'Running')
+        return _ok('')
+
+    def _VM_shutdown(self, ref):
+        vm = self._vms.get(ref)
+        if vm is None:
+            return _failure('HANDLE_INVALID', 'VM', ref)
+        if vm['power_state'] != 'Running':
+            return _failure('VM_BAD_POWER_STATE', ref, 'running', vm['power_state'].lower())
+        self._set_power_state(ref, 'Halted')
+        return _ok('')
+
+    # tasks
+
+    def _Async_VM_start(self, ref, paused=False, force=False):
+        vm = self._vms.get(ref)
+        if vm is None:
+            return _failure('HANDLE_INVALID', 'VM', ref)
+        task_ref = 'OpaqueRef:task-{}'.format(uuid.uuid4())
+        task = self._tasks[task_ref] = {'uuid': task_ref[11:], 'status': 'pending', 'progress': 0.0,
+                                        'error_info': [], 'result': ''}
+        self._emit('task', 'add', task_ref, task)
+        timer = threading.Timer(self.boot_time, self._finish_start, (task_ref, ref))
+        timer.daemon = True
+        timer.start()
+        return _ok(task_ref)
+
+    def _finish_start(self, task_ref, ref):
+        with self._lock:
+            task = self._tasks.get(task_ref)
+            if task is None:
+                return
+            vm = self._vms[ref]
+            if vm['power_state'] == 'Halted':
+                self._set_power_state(ref, 'Running')
+                task.update(status='success', progress=1.0)
+            else:
+                task.update(status='failure', progress=1.0,
+                            error_info=['VM_BAD_POWER_STATE', ref, 'halted', vm['power_state'].lower()])
+            self._emit('task', 'mod', task_ref, task)
+
+    def _task_get_record(self, ref):
+        if ref not in self._tasks:
+            return _failure('HANDLE_INVALID', 'task', ref)
+        return _ok(self._tasks[ref])
+
+    def _task_destroy(self, ref):
+        task = self._tasks.pop(ref, None)
+        if task is not None:
+            self._emit('task', 'del', ref, task)
+        return _ok('')
+
+    # events
+
+    def _event_from(self, classes, token, timeout):
+        classes = set(c.lower() for c in classes)
+        if token == '':
+            # a snapshot of all objects of the classes
+            events = []
+            for cls, objects in (('VM', self._vms), ('VM_guest_metrics', self._metrics),
+                                 ('task', self._tasks)):
+                if cls.lower() in classes:
+                    events.extend({'class': cls, 'operation': 'add', 'ref': ref, 'snapshot': obj}
+                                  for ref, obj in objects.items())
+            return _ok({'events': events, 'token': str(len(self._events)), 'valid_ref_counts': {}})
+        start = int(token)
+        deadline = time.time() + timeout
+        while True:
+            events = [e for e in self._events[start:] if e['class'].lower() in classes]
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return _ok({'events': events, 'token': str(len(self._events)), 'valid_ref_counts': {}})
+            self._lock.wait(remaining)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake XAPI pool.")
+    parser.add_argument('--vms', type=int, default=100)
+    parser.add_argument('--owners', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--boot-time', type=float, default=1.0)
+    args = parser.parse_args()
+    server = FakeXapi(vms=args.vms, owners=args.owners, latency=args.latency, boot_time=args.boot_time)
+    print server.start()
+    sys.stdout.flush()
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Load generator driving the xsvds falcon app against local backend stand-ins.
+
+Starts a fake XAPI server (`fake_xapi`) in a process of its own, so that
+it does not compete with the app for the interpreter lock, installs the
+in-process LDAP stand-in (`fake_ldap`), loads the app with a generated
+configuration and runs `--clients` concurrent clients. Each client repeatedly logs in as one of
+the VM owners, sends `--heartbeats` heartbeats and connects to one of its
+VMs. Reports throughput, p50/p99 latency per route and the backend calls
+made per request.
+
+    python bench/loadgen.py --vms 100,1000,10000 --clients 8 --rounds 20
+
+Several pool sizes are run in separate processes, one after the other.
+`--config` merges a YAML file into the generated configuration, e.g. to
+compare `xs.inventory.enabled` or `ldap.cache.enabled`.
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import fake_ldap
+
+PASSWORD = 'password'
+
+
+def merge(base, override):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def make_config(args, xapi_address, workdir):
+    from cryptography.fernet import Fernet
+    conf = {
+        'xs': {
+            'ip': xapi_address,
+            'username': 'root',
+            'password': 'bench',
+            'sessions': args.clients,
+            'transport': {'pool_size': args.clients},
+            'inventory': {'enabled': args.inventory, 'timeout': 5},
+            'scheduler': {'enabled': True, 'max_concurrent': 10, 'per_host': 4},
+        },
+        'ldap': {'ip': '127.0.0.1', 'port': 389, 'domain': 'bench.local', 'pool_size': args.clients},
+        'token': {'secret': Fernet.generate_key(), 'revocation_dir': os.path.join(workdir, 'revocation')},
+        'logging': {'filename': os.path.join(workdir, 'xsvds.log'), 'level': 'WARNING'},
+        'metrics': {'enabled': False},
+    }
+    if args.config:
+        with open(args.config) as f:
+            merge(conf, yaml.safe_load(f) or {})
+    return conf
+
+
+class Client(threading.Thread):
+    """Logs in, sends heartbeats and connects, `rounds` times."""
+
+    def __init__(self, app, user, args, results):
+        threading.Thread.__init__(self)
+        from falcon import testing
+        self.client = testing.TestClient(app)
+        self.user = user
+        self.args = args
+        self.results = results
+
+    def post(self, route, doc):
+        start = time.time()
+        result = self.client.simulate_post(route, body=json.dumps(doc),
+                                           headers={'Content-Type': 'application/json'})
+        self.results.append((route, time.time() - start, result.status[:3]))
+        return result
+
+    def run(self):
+        for i in range(self.args.rounds):
+            result = self.post('/v1/login', {'username': self.user, 'password': PASSWORD})
+            if not result.status.startswith('200'):
+                continue
+            token = result.json['token']
+            vms = sorted(result.json['vms'])
+            for _ in range(self.args.heartbeats):
+                self.post('/v1/heartbeat', {'token': token})
+            if vms:
+                self.post('/v1/conn', {'token': token, 'vm_id': vms[i % len(vms)]})
+
+
+def percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def start_xapi(args):
+    """Start the fake XAPI server process.
+
+    Returns:
+        tuple: (process, XML-RPC proxy to control the server, 'host:port').
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_xapi.py'),
+                                '--vms', str(args.vms), '--owners', str(args.owners),
+                                '--latency', str(args.xapi_latency), '--boot-time', str(args.boot_time)],
+                               stdout=subprocess.PIPE)
+    address = process.stdout.readline().strip()
+    return process, xmlrpclib.ServerProxy('http://{}'.format(address)), address
+
+
+def report(args, results, elapsed, xapi_calls, ldap_calls):
+    print "== {} VMs, {} owners, {} clients, {:.1f}s ==".format(args.vms, args.owners, args.clients, elapsed)
+    print "{:<16} {:>8} {:>7} {:>9} {:>9} {:>9}".format('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms')
+    routes = sorted(set(r[0] for r in results))
+    for route in routes:
+        latencies = sorted(r[1] for r in results if r[0] == route)
+        errors = sum(1 for r in results if r[0] == route and r[2][0] != '2')
+        print "{:<16} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f}".format(route, len(latencies), errors,
+                len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+    total = len(results)
+    print "total {} requests, {:.1f} req/s".format(total, total / elapsed)
+    xapi_total = sum(xapi_calls.values())
+    print "XAPI calls: {} ({:.2f} per request)".format(xapi_total, float(xapi_total) / max(total, 1))
+    for method, count in xapi_calls.most_common(8):
+        print "    {:<40} {:>8}".format(method, count)
+    print "LDAP operations: {}".format(', '.join('{} {}'.format(k, v) for k, v in sorted(ldap_calls.items())))
+
+
+def run(args):
+    fake_ldap.install(latency=args.ldap_latency, password=PASSWORD)
+    xapi, control, address = start_xapi(args)
+
+    workdir = tempfile.mkdtemp(prefix='xsvds-bench-')
+    with open(os.path.join(workdir, 'config.yml'), 'w') as f:
+        yaml.safe_dump(make_config(args, address, workdir), f, default_flow_style=False)
+    os.chdir(workdir)  # vds.config reads config.yml from the working directory
+    from vds import xsvds
+
+    # leave out the calls made while starting up
+    if args.inventory:
+        time.sleep(0.5)
+    control.bench.reset()
+    fake_ldap.calls.clear()
+
+    results = []
+    clients = [Client(xsvds.app, 'user{}'.format(i % args.owners), args, results)
+               for i in range(args.clients)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    xapi_calls = collections.Counter(control.bench.calls())
+    xapi.kill()
+    report(args, results, elapsed, xapi_calls, fake_ldap.calls)
+    sys.stdout.flush()
+    os._exit(0)  # skip the teardown of the app's daemon threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vms', default='100', help="pool sizes, comma-separated")
+    parser.add_argument('--owners', type=int, default=0, help="VM owners, defaults to a tenth of the VMs")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--rounds', type=int, default=20, help="logins per client")
+    parser.add_argument('--heartbeats', type=int, default=3, help="heartbeats per login")
+    parser.add_argument('--xapi-latency', type=float, default=0.0, help="seconds added to each XAPI call")
+    parser.add_argument('--ldap-latency', type=float, default=0.0, help="seconds added to each LDAP operation")
+    parser.add_argument('--boot-time', type=float, default=1.0, help="seconds a VM start takes")
+    parser.add_argument('--no-inventory', dest='inventory', action='store_false',
+                        help="query XAPI instead of the event-driven inventory")
+    parser.add_argument('--config', help="YAML file merged into the generated configuration")
+    args = parser.parse_args()
+
+    sizes = [int(v) for v in args.vms.split(',')]
+    if len(sizes) > 1:
+        # the app is configured once per process
+        argv = []
+        skip = False
+        for arg in sys.argv[1:]:
+            if not skip and not arg.startswith('--vms'):
+                argv.append(arg)
+            skip = arg == '--vms'
+        for size in sizes:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--vms', str(size)] + argv)
+            print
+        return
+
+    args.vms = sizes[0]
+    args.owners = args.owners or max(1, args.vms // 10)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
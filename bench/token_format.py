@@ -0,0 +1,63 @@
+"""Compares the legacy JSON token format with the compact one.
+
+Reports the token size and the issue/verify throughput of both formats.
+Run from the directory holding `config.yml`:
+
+    python bench/token_format.py [-n ROUNDS] [-u USERNAME]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from vds import token
+
+
+def legacy_issue(payload):
+    data = {
+        'issued_at': time.time(),
+        'expire_after': token._delta,
+        'payload': payload
+    }
+    return token._cipher.encrypt(json.dumps(data))
+
+
+def legacy_verify(t):
+    return json.loads(token._cipher.decrypt(t, ttl=token._delta))['payload']
+
+
+def compact_verify(t):
+    return token._decode(token._cipher.decrypt(t, ttl=token._delta))
+
+
+def rate(func, arg, rounds):
+    start = time.time()
+    for _ in xrange(rounds):
+        func(arg)
+    return rounds / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=20000)
+    parser.add_argument('-u', '--username', default='someone.with.a.long.name')
+    args = parser.parse_args()
+    token.init(tempfile.mkdtemp())
+
+    legacy = legacy_issue(args.username)
+    compact = token.issue(args.username)
+    print "{:<10} {:>6} {:>12} {:>12}".format('format', 'bytes', 'issue/s', 'verify/s')
+    print "{:<10} {:>6} {:>12.0f} {:>12.0f}".format('legacy', len(legacy),
+            rate(legacy_issue, args.username, args.rounds), rate(legacy_verify, legacy, args.rounds))
+    print "{:<10} {:>6} {:>12.0f} {:>12.0f}".format('compact', len(compact),
+            rate(token.issue, args.username, args.rounds), rate(compact_verify, compact, args.rounds))
+    print "{:<10} {:>6} {:>12} {:>12.0f}".format('cached', len(compact), '-',
+            rate(token.verify, compact, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
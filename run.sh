@@ -1,3 +1,7 @@
 #!/bin/bash
 
-.venv/bin/uwsgi --http :8893 --wsgi-file vds/xsvds.py --callable app
+# The app starts background threads (e.g. the XAPI inventory), which uwsgi
+# only runs with --enable-threads. --lazy-apps loads the app in each worker
+# so that they are started after fork.
+.venv/bin/uwsgi --http :8893 --wsgi-file vds/xsvds.py --callable app \
+    --enable-threads --lazy-apps --threads 4
@@ -1,14 +1,24 @@
 from vds.api.login import Login
+from vds.api.logout import Logout
 from vds.api.connect import Connect
 from vds.api.failsafe import Failsafe
 from vds.api.heartbeat import Heartbeat
+from vds.api.metrics import Metrics
+from vds.api.profile import Profile
 from vds.api.settings import Settings
+from vds.api.status import Status
+from vds.api.vms import VMs
 
 login = Login()
+logout = Logout()
 connect = Connect()
 failsafe = Failsafe()
 heartbeat = Heartbeat()
+metrics = Metrics()
+profile = Profile()
 settings = Settings()
+status = Status()
+vms = VMs()
 
-__all__ = [login, connect, failsafe, heartbeat, settings]
+__all__ = [login, logout, connect, failsafe, heartbeat, metrics, profile, settings, status, vms]
 
@@ -1,7 +1,7 @@
 import logging
 import falcon
 
-from vds import token
+from vds import token, preboot
 from vds.interface import xapi
 from vds.exceptions import *
 
@@ -11,26 +11,59 @@ log = logging.getLogger(__name__)
 class Connect(object):
     """Handler class for `conn` route"""
     def on_post(self, req, resp):
-        """handle POST request and generate response"""
+        """handle POST request and generate response
+
+        The VM start is queued and run asynchronously, poll `conn/status`
+        until its status is `running` and `rdp_ip` is set.
+        """
         data = req.context['doc']
         user = req.context['token']
         vm_id = data['vm_id']
+        preboot.record_use(user, vm_id)
 
         try:
             log.info("Attempt to start VM [{}] for user [{}]..".format(vm_id, user))
-            xapi.current_session().start_vm(vm_id)
+            position = xapi.current_session().request_start(user, vm_id)
+            log.info("Start of VM [{}] submitted, queue position {}.".format(vm_id, position))
         except XapiOperationError as xoe:
             # starting a running VM, log and ignore
             log.info(xoe)
 
-        info = xapi.current_session().get_vm_info(vm_id)
-        log.info("Retrieved info of VM [{}].".format(vm_id))
-
         resp.status = falcon.HTTP_200
         resp.context['result'] = {
-            vm_id: {
-                'rdp_ip': info['ip'],
-                'rdp_port': 3389
-            }
+            vm_id: connection_info(vm_id)
         }
 
+
+def connection_info(vm_id, wait=0):
+    """Describes the boot status and RDP endpoint of a VM.
+
+    Args:
+        vm_id (str): VM uuid.
+        wait (float): seconds to wait for a pending start to finish.
+
+    Returns:
+        dict: `status` is one of `queued`, `starting`, `running`, `failed`
+        or the lower-cased power state of the VM.
+    """
+    session = xapi.current_session()
+    position = session.queue_position(vm_id)
+    task = session.get_task(vm_id, wait=wait) if not position else None
+    info = session.get_vm_info(vm_id)
+    log.info("Retrieved info of VM [{}].".format(vm_id))
+
+    ret = {
+        'status': info['power_state'].lower(),
+        'rdp_ip': info['ip'],
+        'rdp_port': 3389
+    }
+    if position:
+        ret['status'] = 'queued'
+        ret['position'] = position
+    elif task is not None and task.pending:
+        ret['status'] = 'starting'
+        ret['progress'] = task.progress
+    elif task is not None and task.status != 'success':
+        ret['status'] = 'failed'
+        ret['err'] = task.error
+    return ret
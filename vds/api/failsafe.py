@@ -10,3 +10,7 @@ class Failsafe(object):
         }
 
         resp.status = falcon.HTTP_500
+
+    def on_get(self, req, resp):
+        """Handles GET request and generate response"""
+        self.on_post(req, resp)
@@ -1,39 +1,76 @@
 import logging
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import falcon
 
-from vds import token
+from vds import token, preboot, resilience, tracing
 from vds.interface import xapi, ldap_ as ldap
+from vds.exceptions import DeadlineExceededError
 
 
 log = logging.getLogger(__name__)
 
 class Login(object):
-    """Handler class for `login` route"""
+    """Handler class for `login` route
+
+    The VMs of the user are looked up on a worker thread while the user is
+    authenticated, so the latency of a login is that of the slower backend
+    rather than their sum. The lookup result is dropped if authentication
+    fails. Logins rejected without asking the directory (empty or recently
+    rejected passwords) do not look up VMs.
+    """
+
+    def __init__(self, workers=4):
+        """
+        Args:
+            workers (int): threads running VM lookups, created on first use.
+        """
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _lookup(self, session, username):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPool(self.workers)
+        return self._executor.apply_async(tracing.call, (resilience.current(), tracing.current(),
+                                                  session.get_vms_by_user, username))
+
     def on_post(self, req, resp):
         """handle POST request and generate response"""
         data = req.context['doc']
         username = data['username']
         password = data['password']
 
-        user_info = ldap.auth(username, password) # raises on failure
+        # rejections not asking the directory come before any XAPI load
+        user_info = ldap.precheck(username, password) # raises on failure
+        session = xapi.current_session()
+        lookup = self._lookup(session, username)
+
+        if user_info is None:
+            user_info = ldap.auth(username, password, prechecked=True) # raises on failure
         log.info("User [{}] logging in. ({})".format(username, user_info))
 
         t = token.issue(username)
         log.info("Token issued for user [{}].".format(username))
 
-        vms = xapi.current_session().get_vms_by_user(username)
+        try:
+            vms = lookup.get(resilience.clamp(_max_wait))
+        except TimeoutError:
+            raise DeadlineExceededError("VM lookup of user [{}] did not finish in time.".format(username))
         log.info("VM info retrieved for user [{}], {} VM(s) in total.".format(username, len(vms)))
 
+        staleness = session.staleness()
+        if staleness is not None:
+            resp.set_header('X-VDS-Inventory-Age', '{:.1f}'.format(staleness))
+
+        preboot.on_login(username, vms)
+
         info = {}
         for i, vm in enumerate(vms):
             log.debug("[{}] {}".format(i+1, vm))
-            info[vm['uuid']] = {
-                'name': vm['name'],
-                'status': vm['power_state'],
-                'public_ip': vm['ip'],
-                'os': vm['os']['distro'] if vm['os'] else 'unknown',
-                'protocol': 0,
-            }
+            info[vm['uuid']] = vm_summary(vm)
 
         resp.context['result'] = {
             'vms': info,
@@ -42,3 +79,21 @@ class Login(object):
 
         resp.status = falcon.HTTP_200
 
+
+
+def vm_summary(vm):
+    """Describes a VM to its user.
+
+    Args:
+        vm (dict): VM info, see `XapiClient.get_vms_by_user()`.
+    """
+    return {
+        'name': vm['name'],
+        'status': vm['power_state'],
+        'public_ip': vm['ip'],
+        'os': vm['os']['distro'] if vm['os'] else 'unknown',
+        'protocol': 0,
+    }
+
+
+_max_wait = 60.0 # seconds to wait for a VM lookup without a request deadline
@@ -0,0 +1,20 @@
+import logging
+import falcon
+
+from vds import token
+from vds.interface import ldap_ as ldap
+
+
+log = logging.getLogger(__name__)
+
+class Logout(object):
+    """Handler class for `logout` route"""
+    def on_post(self, req, resp):
+        """Revokes the token of the request and returns empty response"""
+        user = req.context['token']
+        token.revoke(req.context['raw_token'])
+        ldap.invalidate(user)
+        log.info("User [{}] logged out.".format(user))
+
+        resp.context['result'] = None
+        resp.status = falcon.HTTP_204
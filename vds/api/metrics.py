@@ -0,0 +1,12 @@
+import falcon
+
+from vds import metrics
+
+
+class Metrics(object):
+    """Handler class for `metrics` route"""
+    def on_get(self, req, resp):
+        """Returns the metrics of all workers in the Prometheus text format"""
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.body = metrics.render()
+        resp.status = falcon.HTTP_200
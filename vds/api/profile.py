@@ -0,0 +1,45 @@
+import logging
+import falcon
+
+from vds.exceptions import HTTPAuthError
+
+
+log = logging.getLogger(__name__)
+
+class Profile(object):
+    """Handler class for `admin/profile` route
+
+    Attributes:
+        profiler (Profiler): the profiler of the worker, None if profiling is disabled.
+        admins (list): users allowed to change the profiler settings.
+    """
+
+    def __init__(self):
+        self.profiler = None
+        self.admins = []
+
+    def on_post(self, req, resp):
+        """Changes the profiler settings and returns them
+
+        `every` sets the sampling rate, `next` profiles the next requests.
+        """
+        user = req.context['token']
+        if user not in self.admins:
+            raise HTTPAuthError("Administrator privileges required")
+        if self.profiler is None:
+            resp.context['result'] = {'err': 'Profiling disabled'}
+            resp.status = falcon.HTTP_404
+            return
+
+        data = req.context['doc']
+        for key in ('every', 'next'):
+            value = data.get(key)
+            if value is not None and (type(value) not in (int, long) or value < 0):
+                resp.context['result'] = {'err': '{} must be a non-negative integer'.format(key)}
+                resp.status = falcon.HTTP_400
+                return
+        self.profiler.configure(every=data.get('every'), pending=data.get('next'))
+        log.info("Profiler settings changed by [{}]: {}".format(user, self.profiler.settings()))
+
+        resp.context['result'] = self.profiler.settings()
+        resp.status = falcon.HTTP_200
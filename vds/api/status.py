@@ -0,0 +1,43 @@
+import logging
+import falcon
+
+from vds import resilience
+from vds.api.connect import connection_info
+
+
+log = logging.getLogger(__name__)
+
+class Status(object):
+    """Handler class for `conn/status` route
+
+    Attributes:
+        max_wait (float): upper bound of the `wait` parameter in seconds.
+        headroom (float): seconds of the request deadline kept for the status
+            lookup after waiting.
+    """
+
+    max_wait = 30.0
+    headroom = 5.0
+
+    def on_post(self, req, resp):
+        """handle POST request and generate response
+
+        Reports the boot status of a VM started through `conn`. With `wait`,
+        the request is held until the start finishes or `wait` seconds pass,
+        at most until `headroom` seconds before the request deadline.
+        """
+        data = req.context['doc']
+        vm_id = data['vm_id']
+        wait = data.get('wait', 0)
+        if type(wait) not in (int, long, float) or not 0 <= wait < float('inf'):
+            resp.context['result'] = {'err': 'wait must be a non-negative number'}
+            resp.status = falcon.HTTP_400
+            return
+        wait = min(float(wait), Status.max_wait)
+        if wait > 0:
+            wait = max(resilience.clamp(wait + Status.headroom) - Status.headroom, 0)
+
+        resp.status = falcon.HTTP_200
+        resp.context['result'] = {
+            vm_id: connection_info(vm_id, wait=wait)
+        }
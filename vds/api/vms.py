@@ -0,0 +1,61 @@
+import hashlib
+import json
+import logging
+import falcon
+
+from vds.api.login import vm_summary
+from vds.interface import xapi
+
+
+log = logging.getLogger(__name__)
+
+class VMs(object):
+    """Handler class for `vms` route
+
+    Lists the VMs of the token's user as `login` does, without authenticating
+    the user again. The token is passed as `Authorization: Bearer <token>`.
+
+    Responses carry an `ETag` of their content, and a request whose
+    `If-None-Match` holds it is answered with 304. With `since=<version>`,
+    the `version` of an earlier response, only the VMs changed since are
+    listed and `removed` lists the VMs the user no longer owns; `full` tells
+    when the version was not usable and all VMs are listed. Versions are only
+    given when VM queries are answered from the inventory.
+    """
+    def on_get(self, req, resp):
+        """handle GET request and generate response"""
+        user = req.context['token']
+        session = xapi.current_session()
+        changes = session.get_vm_changes(user, req.get_param('since'))
+
+        result = {
+            'vms': dict((vm['uuid'], vm_summary(vm)) for vm in changes['vms']),
+            'removed': sorted(changes['removed']),
+            'full': changes['full'],
+        }
+        # the version is left out, so that workers agree on the tag of a content
+        etag = '"{}"'.format(hashlib.sha1(json.dumps(result, sort_keys=True)).hexdigest()[:20])
+        resp.set_header('ETag', etag)
+        resp.set_header('Cache-Control', 'private, no-cache')
+        staleness = session.staleness()
+        if staleness is not None:
+            resp.set_header('X-VDS-Inventory-Age', '{:.1f}'.format(staleness))
+
+        if _matches(req.get_header('If-None-Match'), etag):
+            resp.context['result'] = None
+            resp.status = falcon.HTTP_304
+            return
+
+        log.debug("{} VM(s) of user [{}] listed{}.".format(len(result['vms']), user,
+                                                          '' if result['full'] else ' as changes'))
+        result['version'] = changes['version']
+        resp.context['result'] = result
+        resp.status = falcon.HTTP_200
+
+
+def _matches(if_none_match, etag):
+    """Tell whether an `If-None-Match` header matches `etag`."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
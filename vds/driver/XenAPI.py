@@ -59,9 +59,14 @@ import xmlrpclib
 import httplib
 import socket
 import sys
+import time
 
 translation = gettext.translation('xen-xm', fallback = True)
 
+# callables invoked after each XML-RPC call with the method name, the
+# seconds taken and the exception raised or None
+request_hooks = []
+
 API_VERSION_1_1 = '1.1'
 API_VERSION_1_2 = '1.2'
 
@@ -136,6 +141,21 @@ class Session(xmlrpclib.ServerProxy):
 
 
     def xenapi_request(self, methodname, params):
+        if not request_hooks:
+            return self._xenapi_request(methodname, params)
+        start = time.time()
+        error = None
+        try:
+            return self._xenapi_request(methodname, params)
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            elapsed = time.time() - start
+            for hook in request_hooks:
+                hook(methodname, elapsed, error)
+
+    def _xenapi_request(self, methodname, params):
         if methodname.startswith('login'):
             self._login(methodname, params)
             return None
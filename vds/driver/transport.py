@@ -0,0 +1,189 @@
+"""Persistent HTTP/1.1 transports for `XenAPI.Session`.
+
+The default `xmlrpclib.Transport` keeps at most one connection and is not
+safe to share between threads. `KeepAliveTransport` keeps a bounded pool of
+idle connections instead, checks them for liveness before reuse and
+transparently reconnects when the server has closed an idle connection.
+Socket timeouts are clamped to the deadline of the current request, if any,
+and a timeout cut short by the deadline is raised as `DeadlineExceededError`
+rather than as a failure of the server.
+"""
+import collections
+import errno
+import httplib
+import select
+import socket
+import threading
+import time
+import xmlrpclib
+
+from vds import resilience, tracing
+from vds.driver.XenAPI import UDSHTTPConnection
+from vds.exceptions import DeadlineExceededError
+
+
+# socket errors meaning the server dropped a reused connection before reading the request
+_STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+# seconds left to the deadline under which a socket timeout is put down to it
+_DEADLINE_SLACK = 0.05
+
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    """XML-RPC transport reusing HTTP/1.1 connections from a bounded pool.
+
+    Attributes:
+        connection_class (type): `httplib.HTTPConnection` or a subclass.
+    """
+
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, pool_size=4, connect_timeout=10.0, read_timeout=60.0,
+                 max_idle=60.0, use_datetime=0):
+        """Build the transport.
+
+        Args:
+            pool_size (int): maximum number of idle connections kept open.
+            connect_timeout (float): seconds to wait for a connection to be established.
+            read_timeout (float): seconds to wait for each socket read or write.
+            max_idle (float): idle connections older than this are closed instead of reused.
+        """
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self._idle = collections.deque()  # (host, connection, released at)
+        self._lock = threading.Lock()
+
+    def request(self, host, handler, request_body, verbose=0):
+        deadline = resilience.current()
+        if deadline is not None:
+            deadline.check('XAPI call')
+        try:
+            return self._request_with_retry(host, handler, request_body, verbose)
+        except socket.timeout as e:
+            if deadline is not None and deadline.remaining() < _DEADLINE_SLACK:
+                raise DeadlineExceededError("XAPI call cut short by the request deadline: {}".format(e))
+            raise
+
+    def _request_with_retry(self, host, handler, request_body, verbose):
+        for attempt in (0, 1):
+            conn, reused = self._checkout(host)
+            try:
+                conn.sock.settimeout(resilience.clamp(self.read_timeout))
+                return self._request(conn, host, handler, request_body, verbose)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # a reused connection may have been closed by the server just
+                # before the request was sent, retry once on a fresh one
+                if reused and attempt == 0 and _is_stale(e):
+                    continue
+                raise
+
+    def _request(self, conn, host, handler, request_body, verbose):
+        if verbose:
+            conn.set_debuglevel(1)
+        self.send_request(conn, handler, request_body)
+        self.send_host(conn, host)
+        self.send_user_agent(conn)
+        self.send_content(conn, request_body)
+        response = conn.getresponse(buffering=True)
+        if response.status != 200:
+            response.read()
+            conn.close()
+            raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                          response.reason, response.msg)
+        self.verbose = verbose
+        tracing.add_bytes(len(request_body), int(response.getheader('content-length', 0)))
+        try:
+            result = self.parse_response(response)
+        except xmlrpclib.Fault:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(host, conn)
+        return result
+
+    def _checkout(self, host):
+        """Return an idle connection to `host`, or a new one.
+
+        Returns:
+            tuple: (connection, whether the connection is reused).
+        """
+        now = time.time()
+        with self._lock:
+            for _ in range(len(self._idle)):
+                entry = self._idle.pop()
+                if entry[0] == host:
+                    break
+                self._idle.appendleft(entry)
+            else:
+                entry = None
+
+        if entry is not None:
+            conn, released_at = entry[1], entry[2]
+            if now - released_at < self.max_idle and _is_alive(conn):
+                return conn, True
+            conn.close()
+
+        return self._connect(host), False
+
+    def _checkin(self, host, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((host, conn, time.time()))
+                return
+        conn.close()
+
+    def _connect(self, host):
+        chost = self.get_host_info(host)[0]
+        conn = self.connection_class(chost, timeout=resilience.clamp(self.connect_timeout))
+        conn.connect()
+        return conn
+
+    def make_connection(self, host):
+        # only used by `xmlrpclib.Transport.single_request`, which `request` bypasses
+        return self._connect(host)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for _, conn, _ in idle:
+            conn.close()
+
+
+class UDSKeepAliveTransport(KeepAliveTransport):
+    """`KeepAliveTransport` over the local xapi Unix domain socket.
+
+    Example:
+
+    session = XenAPI.Session("http://_var_xapi_xapi/", transport=UDSKeepAliveTransport())
+    """
+
+    connection_class = UDSHTTPConnection
+
+
+def _is_alive(conn):
+    """Checks an idle connection before reuse.
+
+    An idle HTTP connection should have nothing to read, a readable socket
+    means the server closed it (EOF) or sent unsolicited data.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+def _is_stale(e):
+    if isinstance(e, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+        return True
+    return isinstance(e, socket.error) and not isinstance(e, socket.timeout) \
+            and e.errno in _STALE_ERRNOS
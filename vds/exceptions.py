@@ -29,6 +29,14 @@ class LdapError(VDSError):
     """Ldap connection/query error."""
 
 
+class BackendUnavailableError(VDSError):
+    """Backend call rejected by an open circuit breaker."""
+
+
+class DeadlineExceededError(VDSError):
+    """Request deadline exceeded before a backend call."""
+
+
 class VDSHTTPError(falcon.HTTPError):
     """Base class for custom falcon exceptions."""
     def __init__(self, status, msg):
@@ -0,0 +1,151 @@
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    """Cached outcomes of the authentications of a user."""
+
+    def __init__(self):
+        self.salt = os.urandom(16)
+        self.digest = None   # digest of the accepted password
+        self.result = None   # directory search result of the accepted password
+        self.expires_at = 0
+        self.failed = set()  # digests of rejected passwords, at most `max_failures`
+        self.failures = 0    # rejections within the current window
+        self.window_ends = 0 # end of the window of the rejections
+
+
+class AuthCache(object):
+    """TTL-bounded LRU cache of LDAP authentication outcomes, keyed by username.
+
+    Passwords are never stored: an entry keeps a salted PBKDF2 digest of the
+    accepted password, along with the directory search result, for `ttl`
+    seconds. Rejections of a user are counted over windows of the shorter
+    `negative_ttl`: rejected passwords are remembered until the end of the
+    window, so repeated attempts with them do not reach the directory, and
+    once `max_failures` are counted any other password is rejected until the
+    window ends, without asking the directory. The lockout does not apply to
+    the cached accepted password while it has not expired, so failed
+    attempts by others cannot lock a user out of a running session; without
+    one, attempts are rejected without even hashing the password. A password
+    not matching the cached one is otherwise always checked against the
+    directory, so a password change takes effect at once.
+    """
+
+    def __init__(self, ttl=300.0, negative_ttl=30.0, max_entries=10000, iterations=10000,
+                 max_failures=5):
+        """Build the cache.
+
+        Args:
+            ttl (float): seconds an accepted password is cached.
+            negative_ttl (float): seconds a rejected password is cached.
+            max_entries (int): maximum number of cached users, least recently
+                used ones are evicted first.
+            iterations (int): PBKDF2 iterations of the password digests.
+            max_failures (int): rejections of a user within `negative_ttl`
+                after which all of its attempts are rejected.
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.iterations = iterations
+        self.max_failures = max_failures
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # username -> _Entry, least recently used first
+        self._lock = threading.Lock()
+
+    def _digest(self, entry, password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hashlib.pbkdf2_hmac('sha256', password, entry.salt, self.iterations)
+
+    def _entry(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is None:
+            entry = _Entry()
+        self._entries[username] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def lookup(self, username, password):
+        """Look up the outcome of an authentication.
+
+        Returns:
+            tuple: (True, search result) if the password was accepted,
+            (False, None) if it was rejected, or None if the directory must
+            be asked.
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[username] = self._entries.pop(username)
+            now = time.time()
+            locked = entry.failures >= self.max_failures and now < entry.window_ends
+            if locked and (entry.digest is None or now >= entry.expires_at):
+                self.hits += 1
+                return False, None
+        digest = self._digest(entry, password)
+        now = time.time()
+        with self._lock:
+            if entry.digest is not None and now < entry.expires_at \
+                    and hmac.compare_digest(entry.digest, digest):
+                self.hits += 1
+                return True, entry.result
+            if locked or now < entry.window_ends and digest in entry.failed:
+                self.hits += 1
+                return False, None
+            self.misses += 1
+            return None
+
+    def accept(self, username, password, result):
+        """Cache an accepted password and the search result of the user."""
+        with self._lock:
+            entry = self._entry(username)
+        digest = self._digest(entry, password)
+        with self._lock:
+            entry.digest = digest
+            entry.result = result
+            entry.expires_at = time.time() + self.ttl
+            entry.failed.discard(digest)
+
+    def reject(self, username, password):
+        """Cache a rejected password."""
+        with self._lock:
+            entry = self._entry(username)
+        digest = self._digest(entry, password)
+        now = time.time()
+        with self._lock:
+            if now >= entry.window_ends:
+                entry.failed.clear()
+                entry.failures = 0
+                entry.window_ends = now + self.negative_ttl
+            entry.failures += 1
+            if len(entry.failed) < self.max_failures:
+                entry.failed.add(digest)
+            if entry.digest is not None and hmac.compare_digest(entry.digest, digest):
+                entry.digest = None
+
+    def invalidate(self, username=None):
+        """Drop the cached outcomes of a user, or of all users if `username` is None."""
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def stats(self):
+        """Return the number of cached users, hits and misses."""
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
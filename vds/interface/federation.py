@@ -0,0 +1,212 @@
+import collections
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from vds import resilience, tracing
+from vds.driver import XenAPI
+from vds.exceptions import VDSError, XapiError, XapiOperationError
+
+
+log = logging.getLogger(__name__)
+
+
+class Federation(object):
+    """A group of XenServer pools behind the `XapiClient` interface.
+
+    User queries fan out to every pool in parallel and the results are merged.
+    VM operations are routed to the pool owning the VM, known from earlier
+    query results or found by probing all pools. Each pool has executor
+    threads of its own, so a hung pool only delays its own calls, and
+    fan-outs give up on pools not answering within `timeout` or the request
+    deadline, which is passed on to the executor threads. Pools can join the
+    federation later with `add()`.
+
+    Attributes:
+        clients (OrderedDict): pool name -> `XapiClient`.
+    """
+
+    def __init__(self, clients, timeout=10.0):
+        """Build the federation.
+
+        Args:
+            clients (OrderedDict): pool name -> authenticated `XapiClient`.
+            timeout (float): seconds to wait for a pool during a fan-out.
+        """
+        self.clients = clients
+        self.timeout = timeout
+        self._executors = dict((name, ThreadPool(client.sessions.size))
+                               for name, client in clients.items())
+        self._pools = {}  # VM uuid -> pool name
+        self._lock = threading.Lock()
+
+    def add(self, name, client):
+        """Add a pool, e.g. one that failed to initialize at first.
+
+        Args:
+            name (str): pool name.
+            client (XapiClient): authenticated client of the pool.
+        """
+        with self._lock:
+            self._executors[name] = ThreadPool(client.sessions.size)
+            clients = collections.OrderedDict(self.clients)
+            clients[name] = client
+            # replaced rather than updated, fan-outs iterate over it unlocked
+            self.clients = clients
+
+    def _fan_out(self, method, *args):
+        """Call `method` on every pool in parallel.
+
+        Returns:
+            OrderedDict: pool name -> result, for the pools that answered in time.
+        """
+        return self._fan_out_each(method, collections.OrderedDict((name, args) for name in self.clients))
+
+    def _fan_out_each(self, method, args):
+        """Call `method` on some pools in parallel, with arguments of their own.
+
+        Args:
+            args (OrderedDict): pool name -> arguments.
+
+        Returns:
+            OrderedDict: pool name -> result, for the pools that answered in time.
+        """
+        deadline, trace = resilience.current(), tracing.current()
+        pending = collections.OrderedDict(
+            (name, self._executors[name].apply_async(tracing.call,
+                    (deadline, trace, getattr(self.clients[name], method)) + tuple(a)))
+            for name, a in args.items())
+        deadline = time.time() + resilience.clamp(self.timeout)
+        results = collections.OrderedDict()
+        for name, result in pending.items():
+            try:
+                results[name] = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                log.warning("Pool [{}] did not answer {} within {}s.".format(name, method, self.timeout))
+            except (VDSError, XenAPI.Failure) as e:
+                log.warning("Pool [{}] failed {}: {}".format(name, method, e))
+        return results
+
+    def _client(self, vm_uuid):
+        """Return the client of the pool owning a VM.
+
+        Raises:
+            XapiError: if no pool knows the VM.
+        """
+        with self._lock:
+            name = self._pools.get(vm_uuid)
+        if name is None:
+            for name, info in self._fan_out('get_vm_info', vm_uuid).items():
+                self._remember(name, [info])
+                break
+            else:
+                raise XapiError("VM [{}] not found in any pool.".format(vm_uuid))
+        return self.clients[name]
+
+    def _remember(self, name, vms):
+        with self._lock:
+            for vm in vms:
+                self._pools[vm['uuid']] = name
+
+    def get_vms_by_user(self, username):
+        """Retrieve the VMs of a user from all pools, see `XapiClient.get_vms_by_user()`.
+
+        Pools failing or not answering in time are left out. Each VM has an
+        additional `pool` key naming its pool.
+        """
+        user_vms = []
+        for name, vms in self._fan_out('get_vms_by_user', username).items():
+            self._remember(name, vms)
+            for vm in vms:
+                vm['pool'] = name
+            user_vms.extend(vms)
+        return user_vms
+
+    def get_vm_changes(self, username, since=None):
+        """Retrieve the VM changes of a user in all pools, see `XapiClient.get_vm_changes()`.
+
+        The version is made of the versions of the pools. If a pool cannot
+        answer from `since`, all pools list all VMs of the user. A pool not
+        answering keeps the version it had in `since` in a partial listing, so
+        that its changes are listed next time, and loses it in a full one.
+        """
+        clients = self.clients
+        versions = since.split(',') if since else []
+        if len(versions) != len(clients):
+            versions = [''] * len(clients)
+        versions = collections.OrderedDict(zip(clients, versions))
+        results = self._fan_out_each('get_vm_changes', collections.OrderedDict(
+                (name, (username, version or None)) for name, version in versions.items()))
+        partial = [name for name, changes in results.items() if not changes['full']]
+        if partial and len(partial) < len(results):
+            results.update(self._fan_out_each('get_vm_changes', collections.OrderedDict(
+                    (name, (username, None)) for name in partial)))
+
+        user_vms, removed = [], []
+        for name, changes in results.items():
+            self._remember(name, changes['vms'])
+            for vm in changes['vms']:
+                vm['pool'] = name
+            user_vms.extend(changes['vms'])
+            removed.extend(changes['removed'])
+            versions[name] = changes['version'] or ''
+        full = all(changes['full'] for changes in results.values())
+        if full:
+            for name in versions:
+                if name not in results:
+                    versions[name] = ''
+        return {
+            'vms': user_vms,
+            'removed': removed,
+            'version': ','.join(versions.values()) if any(versions.values()) else None,
+            'full': full,
+        }
+
+    def top_owners(self, n=10):
+        """List the users owning the most VMs across pools, see `XapiClient.top_owners()`."""
+        counts = collections.Counter()
+        # a pool's top n is not enough to rank users across pools
+        for owners in self._fan_out('top_owners', None).values():
+            counts.update(dict(owners))
+        return counts.most_common(n)
+
+    def staleness(self):
+        """Return the staleness of the stalest pool inventory, see `XapiClient.staleness()`."""
+        values = [c.staleness() for c in self.clients.values()]
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
+
+    def _route(self, vm_uuid, method, *args, **kwargs):
+        client = self._client(vm_uuid)
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        except XapiOperationError:
+            raise
+        except XapiError:
+            # the VM may have moved, look it up again next time
+            with self._lock:
+                self._pools.pop(vm_uuid, None)
+            raise
+
+    def get_vm_info(self, vm_uuid):
+        return self._route(vm_uuid, 'get_vm_info', vm_uuid)
+
+    def get_affinity(self, vm_uuid):
+        return self._route(vm_uuid, 'get_affinity', vm_uuid)
+
+    def start_vm(self, vm_uuid):
+        return self._route(vm_uuid, 'start_vm', vm_uuid)
+
+    def request_start(self, user, vm_uuid):
+        return self._route(vm_uuid, 'request_start', user, vm_uuid)
+
+    def queue_position(self, vm_uuid):
+        return self._route(vm_uuid, 'queue_position', vm_uuid)
+
+    def get_task(self, vm_uuid, wait=0):
+        return self._route(vm_uuid, 'get_task', vm_uuid, wait=wait)
+
+    def shutdown_vm(self, vm_uuid):
+        return self._route(vm_uuid, 'shutdown_vm', vm_uuid)
@@ -0,0 +1,343 @@
+import collections
+import heapq
+import logging
+import threading
+import time
+import uuid
+
+from vds.driver import XenAPI
+from vds.driver.transport import KeepAliveTransport
+
+
+log = logging.getLogger(__name__)
+
+
+class OwnerIndex(object):
+    """Index of VM refs by owner name.
+
+    Not thread-safe, callers serialize access.
+    """
+
+    def __init__(self, owner_field):
+        """
+        Args:
+            owner_field (str): the field in `other_config` holding the owner name.
+        """
+        self.owner_field = owner_field
+        self._refs = {}    # owner -> set of VM refs
+        self._owners = {}  # VM ref -> owner
+
+    def update(self, ref, vm):
+        """Index a created or modified VM record."""
+        owner = vm['other_config'].get(self.owner_field)
+        if self._owners.get(ref) == owner:
+            return
+        self.remove(ref)
+        if owner is not None:
+            self._owners[ref] = owner
+            self._refs.setdefault(owner, set()).add(ref)
+
+    def remove(self, ref):
+        """Drop a destroyed VM from the index."""
+        owner = self._owners.pop(ref, None)
+        if owner is None:
+            return
+        refs = self._refs[owner]
+        refs.discard(ref)
+        if not refs:
+            del self._refs[owner]
+
+    def clear(self):
+        self._refs.clear()
+        self._owners.clear()
+
+    def owner(self, ref):
+        """Return the owner of a VM, or None."""
+        return self._owners.get(ref)
+
+    def refs(self, owner):
+        """Return the refs of VMs owned by `owner`."""
+        return list(self._refs.get(owner, ()))
+
+    def top(self, n):
+        """Return up to `n` (all if None) (owner, VM count) tuples, most VMs first."""
+        counts = ((owner, len(refs)) for owner, refs in self._refs.items())
+        if n is None:
+            return sorted(counts, key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(n, counts, key=lambda item: item[1])
+
+
+class Inventory(object):
+    """In-memory replica of the VM and VM_guest_metrics records of a pool.
+
+    The records are loaded once and then kept current by a background thread
+    subscribed to XAPI `event.from`. The event session is separate from the
+    session used for requests since `event.from` blocks for up to `timeout`.
+    Events of further classes can be forwarded to listeners.
+
+    Every change to a VM or its guest metrics increments the version of the
+    inventory, so that `changes()` can tell which VMs of an owner changed
+    since a version. Versions are prefixed by an epoch, renewed on every
+    (re)load, and are not comparable across processes.
+
+    Attributes:
+        classes (list): XAPI classes to subscribe to.
+        ready (bool): whether the initial load has completed.
+    """
+
+    def __init__(self, url, username, password, owner_field, listeners=None,
+                 timeout=30.0, retry_interval=5.0, max_removed=10000):
+        """Build the inventory.
+
+        Args:
+            url (str): XAPI url.
+            username (str): XenServer root username.
+            password (str): XenServer root password.
+            owner_field (str): the field in `other_config` holding the VM owner.
+            listeners (dict): XAPI class name -> callable, called with each
+                event of that class outside of the initial load.
+            timeout (float): seconds a single `event.from` call may block.
+            retry_interval (float): seconds to wait before resyncing after an error.
+            max_removed (int): VM removals remembered for `changes()`, older
+                versions get all VMs of the owner.
+        """
+        self.url = url
+        self.timeout = float(timeout)
+        self.retry_interval = retry_interval
+        self._listeners = dict((cls.lower(), l) for cls, l in (listeners or {}).items())
+        self.classes = ['VM', 'VM_guest_metrics'] + list(listeners or ())
+        self._credentials = (username, password)
+        self._session = None
+        self._token = ''
+        self._vms = {}      # VM ref -> VM record
+        self._metrics = {}  # VM_guest_metrics ref -> VM_guest_metrics record
+        self._uuids = {}    # VM uuid -> VM ref
+        self._guests = {}   # VM_guest_metrics ref -> VM ref
+        self._owners = OwnerIndex(owner_field)
+        self._epoch = None
+        self._version = 0   # number of changes applied
+        self._floor = 0     # oldest version `changes()` can start from
+        self._changed = {}  # VM ref -> version of its last change
+        self._removed = collections.deque(maxlen=max_removed)  # (version, VM uuid, former owner)
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._synced_at = None
+        self.ready = False
+
+    def start(self):
+        """Load the records and start following events in a daemon thread.
+
+        Raises:
+            XenAPI.Failure, IOError: if the initial load failed.
+        """
+        self._sync()
+        self._thread = threading.Thread(target=self._run, name='xapi-inventory')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop following events. The thread exits after the pending `event.from` returns."""
+        self._stopped.set()
+
+    def staleness(self):
+        """Seconds elapsed since the records were last confirmed current.
+
+        Returns:
+            float, or None if the inventory was never loaded.
+        """
+        if self._synced_at is None:
+            return None
+        return time.time() - self._synced_at
+
+    def get_by_uuid(self, vm_uuid):
+        """Look up a VM by uuid.
+
+        Returns:
+            tuple: (VM record, VM_guest_metrics record or None), or None if unknown.
+        """
+        with self._lock:
+            ref = self._uuids.get(vm_uuid)
+            if ref is None:
+                return None
+            return self._pair(ref)
+
+    def find(self, predicate):
+        """Return (VM record, VM_guest_metrics record) pairs of VMs matching `predicate`.
+
+        Args:
+            predicate (callable): called with a VM record.
+        """
+        with self._lock:
+            return [self._pair(ref) for ref, vm in self._vms.items() if predicate(vm)]
+
+    def owned_by(self, owner):
+        """Return (VM record, VM_guest_metrics record) pairs of VMs owned by `owner`."""
+        with self._lock:
+            return [self._pair(ref) for ref in self._owners.refs(owner)]
+
+    def top_owners(self, n):
+        """Return up to `n` (all if None) (owner, VM count) tuples, most VMs first."""
+        with self._lock:
+            return self._owners.top(n)
+
+    def changes(self, owner, since=None):
+        """Return the changes to the VMs of `owner` since a version.
+
+        Args:
+            owner (str): VM owner.
+            since (str): version returned by an earlier call, None for all VMs.
+
+        Returns:
+            tuple: ((VM record, VM_guest_metrics record) pairs of the VMs
+            changed, uuids of the VMs `owner` no longer owns, current version,
+            whether `since` was not usable and all VMs of `owner` are listed).
+        """
+        with self._lock:
+            version = '{}:{}'.format(self._epoch, self._version)
+            start = self._parse_version(since)
+            refs = self._owners.refs(owner)
+            if start is None:
+                return [self._pair(ref) for ref in refs], [], version, True
+            pairs = [self._pair(ref) for ref in refs if self._changed.get(ref, 0) > start]
+            listed = set(vm['uuid'] for vm, _ in pairs)
+            removed = []
+            for changed_at, vm_uuid, former in reversed(self._removed):
+                if changed_at <= start:
+                    break
+                if former == owner and vm_uuid not in listed:
+                    listed.add(vm_uuid)
+                    removed.append(vm_uuid)
+            return pairs, removed, version, False
+
+    def _parse_version(self, since):
+        """Return the change count of version `since`, None if it is not usable."""
+        try:
+            epoch, count = since.split(':')
+            count = int(count)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self._epoch or not self._floor <= count <= self._version:
+            return None
+        return count
+
+    def _pair(self, ref):
+        vm = self._vms[ref]
+        return vm, self._metrics.get(vm['guest_metrics'])
+
+    def _login(self):
+        # the read timeout must outlast a blocking `event.from`
+        transport = KeepAliveTransport(pool_size=1, read_timeout=self.timeout + 30.0)
+        self._session = XenAPI.Session(self.url, transport=transport)
+        self._session.xenapi.login_with_password(*self._credentials)
+
+    def _logout(self):
+        """Log the event session out, best effort, so that it does not linger on the server."""
+        session, self._session = self._session, None
+        if session is None:
+            return
+        try:
+            session.xenapi.session.logout()
+        except Exception as e:
+            log.debug("Unable to log out the inventory session: {}".format(e))
+
+    def _event_from(self, token, timeout):
+        # `from` is a python keyword, hence getattr
+        return getattr(self._session.xenapi.event, 'from')(self.classes, token, timeout)
+
+    def _sync(self):
+        """(Re)load all records. An empty token makes `event.from` return a snapshot."""
+        if self._session is None:
+            self._login()
+        result = self._event_from('', 0.0)
+        with self._lock:
+            self._vms.clear()
+            self._metrics.clear()
+            self._uuids.clear()
+            self._guests.clear()
+            self._owners.clear()
+            for event in result['events']:
+                self._apply(event)
+            # changes from before the load are unknown
+            self._epoch = uuid.uuid4().hex[:8]
+            self._floor = self._version
+            self._changed.clear()
+            self._removed.clear()
+            self._token = result['token']
+            self._synced_at = time.time()
+            self.ready = True
+        log.info("Inventory loaded: {} VM(s), {} guest metrics.".format(
+            len(self._vms), len(self._metrics)))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                result = self._event_from(self._token, self.timeout)
+                with self._lock:
+                    for event in result['events']:
+                        self._apply(event)
+                    self._token = result['token']
+                    self._synced_at = time.time()
+                self._notify(result['events'])
+            except Exception as e:
+                log.warning("Inventory event stream interrupted: {}".format(e))
+                self._stopped.wait(self.retry_interval)
+                self._resync()
+
+    def _resync(self):
+        self._logout()
+        try:
+            self._sync()
+        except Exception as e:
+            log.warning("Inventory resync failed: {}".format(e))
+
+    def _notify(self, events):
+        for event in events:
+            listener = self._listeners.get(event['class'].lower())
+            if listener is not None:
+                listener(event)
+
+    def _apply(self, event):
+        cls = event['class'].lower()
+        ref = event['ref']
+        op = event['operation']
+        if cls == 'vm':
+            former = self._owners.owner(ref)
+            if op == 'del':
+                vm = self._vms.pop(ref, None)
+                if vm is not None:
+                    self._uuids.pop(vm['uuid'], None)
+                    self._guests.pop(vm['guest_metrics'], None)
+                    if former is not None:
+                        self._forget(vm['uuid'], former)
+                self._owners.remove(ref)
+                self._changed.pop(ref, None)
+            elif 'snapshot' in event:
+                vm = event['snapshot']
+                self._vms[ref] = vm
+                self._uuids[vm['uuid']] = ref
+                if vm['guest_metrics'] != 'OpaqueRef:NULL':
+                    self._guests[vm['guest_metrics']] = ref
+                self._owners.update(ref, vm)
+                if former is not None and former != self._owners.owner(ref):
+                    self._forget(vm['uuid'], former)
+                self._touch(ref)
+        elif cls == 'vm_guest_metrics':
+            if op == 'del':
+                self._metrics.pop(ref, None)
+            elif 'snapshot' in event:
+                self._metrics[ref] = event['snapshot']
+            vm_ref = self._guests.get(ref)
+            if vm_ref is not None:
+                self._touch(vm_ref)
+
+    def _touch(self, ref):
+        self._version += 1
+        self._changed[ref] = self._version
+
+    def _forget(self, vm_uuid, former):
+        """Record that `former` no longer owns a VM."""
+        self._version += 1
+        if len(self._removed) == self._removed.maxlen:
+            self._floor = self._removed[0][0]
+        self._removed.append((self._version, vm_uuid, former))
@@ -1,48 +1,482 @@
+import contextlib
 import logging
+import threading
+import time
+import Queue
 import ldap
+import ldap.filter
 
-from vds.exceptions import AuthError, LdapError
+from vds import metrics, resilience, tracing
+from vds.exceptions import AuthError, BackendUnavailableError, DeadlineExceededError, LdapError
+from vds.interface.auth_cache import AuthCache
 
 
 log = logging.getLogger(__name__)
 
+# errors after which a connection is not reused
+_CONNECTION_ERRORS = (ldap.CONNECT_ERROR, ldap.SERVER_DOWN, ldap.TIMEOUT)
+
 
 class _defs(object):
-    ldap = None
+    servers = []
     base_dn = None
+    search_base = None
+    attributes = None
+    size_limit = None
+    group_attribute = None
+    group_ttl = None
+    groups = {}  # username -> (expiry, group DNs)
+    groups_lock = threading.Lock()
     domain = None
+    timeout = None
+    cache = None
+
+
+class ConnectionPool(object):
+    """A bounded pool of LDAP connections.
+
+    Connections are created lazily up to `size`. If `who` is given, every
+    connection is bound as `who` when created, otherwise callers bind the
+    connections they check out themselves. Connections raising connection
+    errors are dropped and replaced by new ones on demand.
+    """
+
+    def __init__(self, uri, size=4, who=None, cred=None, checkout_timeout=10.0):
+        """Build the pool.
+
+        Args:
+            uri (str): LDAP server uri.
+            size (int): maximum number of connections.
+            who (str): DN to bind new connections as, if any.
+            cred (str): password of `who`.
+            checkout_timeout (float): seconds to wait for a connection when
+                all of them are in use.
+        """
+        self.uri = uri
+        self.size = size
+        self.who = who
+        self.cred = cred
+        self.checkout_timeout = checkout_timeout
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self, timeout):
+        """Check out a connection for the duration of the `with` block.
+
+        Args:
+            timeout (float): network and operation timeout to set on the connection.
+
+        Raises:
+            LdapError: if no connection became available within `checkout_timeout`
+                or a new connection failed to bind.
+        """
+        conn = self._checkout()
+        try:
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+            conn.set_option(ldap.OPT_TIMEOUT, timeout)
+            yield conn
+        except _CONNECTION_ERRORS:
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._idle.put(conn)
+            raise
+        else:
+            self._idle.put(conn)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self._lock:
+            grow = self._created < self.size
+            if grow:
+                self._created += 1
+        if not grow:
+            try:
+                return self._idle.get(timeout=resilience.clamp(self.checkout_timeout))
+            except Queue.Empty:
+                raise LdapError("No LDAP connection available after {}s.".format(self.checkout_timeout))
+
+        try:
+            conn = ldap.initialize(self.uri)
+            conn.set_option(ldap.OPT_REFERRALS, 0) # no idea what this does, but it is necessary
+            if self.who is not None:
+                conn.set_option(ldap.OPT_NETWORK_TIMEOUT, resilience.clamp(self.checkout_timeout))
+                conn.simple_bind_s(self.who, self.cred)
+            return conn
+        except ldap.LDAPError as e:
+            with self._lock:
+                self._created -= 1
+            # a failure of the pool's own bind is a backend error, whatever the user
+            raise LdapError("LDAP connection to [{}] failed: {}".format(self.uri, e))
+        except BaseException:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+class Server(object):
+    """A directory server, with its connection pools and health.
 
+    Attributes:
+        name (str): ip:port of the server.
+        healthy (bool): whether the last probe or call succeeded.
+        latency (float): moving average of probe bind times in seconds,
+            None until probed.
+    """
+
+    def __init__(self, ip, port, timeout=10.0, pool_size=4, bind_dn=None, bind_password=None,
+                 service_pool_size=2):
+        """Build the server, see `init()` for the arguments."""
+        self.name = '{}:{}'.format(ip, port)
+        self.uri = 'ldap://{}'.format(self.name)
+        self.bind_dn = bind_dn
+        self.bind_password = bind_password
+        self.pool = ConnectionPool(self.uri, size=pool_size, checkout_timeout=timeout)
+        self.service = None
+        if bind_dn:
+            self.service = ConnectionPool(self.uri, size=service_pool_size, who=bind_dn,
+                    cred=bind_password, checkout_timeout=timeout)
+        self.breaker = resilience.breaker('ldap:{}'.format(self.name))
+        self.healthy = True
+        self.latency = None
+
+    def available(self):
+        """Return whether the server is worth trying first."""
+        return self.healthy and self.breaker.state != 'open'
+
+    def failed(self, error):
+        """Mark the server unhealthy until its next successful probe."""
+        if self.healthy:
+            log.warning("LDAP server [{}] marked unhealthy: {}".format(self.name, error))
+        self.healthy = False
 
-def init(ip, port, domain):
+    def probe(self, timeout):
+        """Time a bind on a fresh connection, as the service account if any, and update the health."""
+        conn = ldap.initialize(self.uri)
+        start = time.time()
+        try:
+            conn.set_option(ldap.OPT_REFERRALS, 0)
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+            conn.set_option(ldap.OPT_TIMEOUT, timeout)
+            with metrics.timer('vds_ldap_seconds', server=self.name, op='probe'):
+                conn.simple_bind_s(self.bind_dn or '', self.bind_password or '')
+        except ldap.LDAPError as e:
+            metrics.inc('vds_ldap_errors_total', server=self.name, op='probe')
+            self.failed(e)
+            return
+        finally:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+        elapsed = time.time() - start
+        self.latency = elapsed if self.latency is None else 0.7 * self.latency + 0.3 * elapsed
+        if not self.healthy:
+            log.info("LDAP server [{}] healthy again.".format(self.name))
+        self.healthy = True
+
+
+def init(ip, port, domain, timeout=10.0, pool_size=4, bind_dn=None, bind_password=None,
+         service_pool_size=2, cache=None, search_base=None, attributes=None, size_limit=2,
+         groups=None, servers=None, probe_interval=30.0):
     """Initializes LDAP connection info.
 
     No connection is made at this stage.
+
+    Args:
+        ip (str): address of the server, unless `servers` is given.
+        port (int): port of the server, unless `servers` is given.
+        timeout (float): seconds each LDAP operation may take.
+        pool_size (int): maximum number of connections used for user binds.
+        bind_dn (str): DN of a service account used for searches. Without one,
+            searches run on the connection bound as the user.
+        bind_password (str): password of the service account.
+        service_pool_size (int): maximum number of service account connections.
+        cache (dict): options of the authentication cache, see `AuthCache`.
+            The cache is used if `enabled` is set.
+        search_base (str): DN user searches start from, defaults to the
+            domain root.
+        attributes (list): user attributes retrieved by searches, defaults
+            to a few naming attributes. Large ones such as `thumbnailPhoto`
+            are better left out.
+        size_limit (int): maximum number of entries a user search returns.
+        groups (dict): group membership lookup options: `enabled`,
+            `attribute` holding the groups of a user (defaults to `memberOf`)
+            and `ttl`, the seconds memberships are cached.
+        servers (list): `ip` and `port` of each server of the domain. Servers
+            are tried healthy and fastest first.
+        probe_interval (float): seconds between health probes of the servers,
+            if there are several of them. 0 disables probing.
     """
-    log.info("Initializing LDAP client: ip[{}], port[{}], domain[{}]".format(ip, port, domain))
+    servers = servers or [{'ip': ip, 'port': port}]
+    log.info("Initializing LDAP client: servers[{}], domain[{}]".format(
+        ', '.join('{}:{}'.format(s['ip'], s['port']) for s in servers), domain))
     dcs = domain.split('.')
     _defs.base_dn = ','.join(["dc={}".format(dc) for dc in dcs])
     log.debug("base_dn: {}".format(_defs.base_dn))
-    _defs.ldap = ldap.initialize('ldap://{}:{}'.format(ip, port))
-    _defs.ldap.set_option(ldap.OPT_REFERRALS, 0) # no idea what this does, but it is necessary
+    _defs.search_base = search_base or _defs.base_dn
+    _defs.attributes = list(attributes or _default_attributes)
+    _defs.size_limit = size_limit
+    groups = groups or {}
+    if groups.get('enabled', False):
+        _defs.group_attribute = groups.get('attribute', 'memberOf')
+        _defs.group_ttl = groups.get('ttl', 600.0)
+        _defs.attributes.append(_defs.group_attribute)
+    _defs.servers = [Server(s['ip'], s['port'], timeout=timeout, pool_size=pool_size,
+                            bind_dn=bind_dn, bind_password=bind_password,
+                            service_pool_size=service_pool_size)
+                     for s in servers]
     _defs.domain = domain
+    _defs.timeout = timeout
+    cache = dict(cache or {})
+    if cache.pop('enabled', False):
+        _defs.cache = AuthCache(**cache)
+        metrics.register(_collect_cache)
+        log.info("LDAP authentication cache enabled: {}".format(cache))
+    if len(_defs.servers) > 1 and probe_interval > 0:
+        prober = threading.Thread(target=_probe, args=(probe_interval,), name='ldap-probe')
+        prober.daemon = True
+        prober.start()
+
+
+_default_attributes = ['cn', 'displayName', 'mail', 'userPrincipalName']
+
+
+def _collect_cache():
+    stats = _defs.cache.stats()
+    return [('vds_ldap_cache_entries', {}, stats['entries']),
+            ('vds_ldap_cache_lookups_total', {'result': 'hit'}, stats['hits']),
+            ('vds_ldap_cache_lookups_total', {'result': 'miss'}, stats['misses'])]
+
+
+def _probe(interval):
+    while True:
+        for server in list(_defs.servers):
+            server.probe(_defs.timeout)
+        time.sleep(interval)
+
+
+def _ordered():
+    """Return the servers, available ones first, then by latency, then in configured order."""
+    return sorted(_defs.servers, key=lambda s: (not s.available(),
+                  s.latency if s.latency is not None else float('inf')))
+
 
+def invalidate(username=None):
+    """Drops cached authentications of a user, or of all users if `username` is None."""
+    if _defs.cache is not None:
+        _defs.cache.invalidate(username)
 
-def auth(username, password):
-    """Authenticates the user in LDAP server."""
+
+def precheck(username, password):
+    """Runs the checks of `auth()` not asking the directory.
+
+    Returns:
+        the cached search result of the user if the password was accepted
+        recently, else None.
+
+    Raises:
+        AuthError: if the password is empty or its rejection is cached.
+    """
+    if not password:
+        # an empty password makes a successful anonymous bind
+        raise AuthError('Authentication failed: user={}, msg=empty password'.format(username))
+    if _defs.cache is None:
+        return None
+    cached = _defs.cache.lookup(username, password)
+    if cached is None:
+        return None
+    accepted, result = cached
+    if not accepted:
+        raise AuthError('Authentication failed: user={}, msg=cached rejection'.format(username))
+    return result
+
+
+def auth(username, password, deadline=None, prechecked=False):
+    """Authenticates the user in LDAP server.
+
+    A pooled connection is (re)bound as the user. A connection dropped by the
+    server is replaced and the authentication retried once. If a server is
+    unreachable, times out or has its circuit open, the next server is
+    tried within the same call. If the
+    authentication cache is enabled, cached outcomes are returned without
+    asking the server.
+
+    Args:
+        deadline (Deadline): bounds the time spent, defaults to the deadline
+            of the current request.
+        prechecked (bool): whether `precheck()` was run already and returned None.
+
+    Raises:
+        AuthError: if the credentials are rejected.
+        LdapError: if all servers are unreachable, timed out or failed the request.
+        BackendUnavailableError: if the circuit breakers of all servers are open.
+        DeadlineExceededError: if the deadline has passed.
+    """
     ##### DEBUG #####
     #return username
     #################
-    username_full = "{}@{}".format(username, _defs.domain)
-    search_filter = "userPrincipalName={}".format(username_full)
+    if not prechecked:
+        result = precheck(username, password)
+        if result is not None:
+            return result
 
+    if _defs.cache is None:
+        return _auth(username, password, deadline)
     try:
-        _defs.ldap.simple_bind_s(username_full, password)
-        r = _defs.ldap.search_s(_defs.base_dn, ldap.SCOPE_SUBTREE, search_filter)
-        #_defs.ldap.unbind_s()
-        return r
-    except (ldap.CONNECT_ERROR, ldap.SERVER_DOWN) as e:
-        raise LdapError(str(e))
-    except ldap.LDAPError as e:
-        #_defs.ldap.unbind_s()
-        raise AuthError('Authentication failed: user={}, msg={}'.format(username, e))
+        result = _auth(username, password, deadline)
+    except AuthError:
+        _defs.cache.reject(username, password)
+        raise
+    _defs.cache.accept(username, password, result)
+    return result
+
+
+def _auth(username, password, deadline):
+    deadline = deadline or resilience.current()
+    error = None
+    for server in _ordered():
+        if deadline is not None:
+            deadline.check('LDAP authentication')
+        try:
+            return _auth_on(server, username, password, deadline)
+        except (LdapError, BackendUnavailableError) as e:
+            metrics.inc('vds_ldap_errors_total', server=server.name, op='auth')
+            server.failed(e)
+            error = e
+    raise error
+
+
+def _auth_on(server, username, password, deadline):
+    username_full = "{}@{}".format(username, _defs.domain)
+
+    with server.breaker.guard((LdapError,)), tracing.span('ldap', 'auth', server=server.name):
+        for attempt in (0, 1):
+            timeout = resilience.clamp(_defs.timeout) if deadline is None else deadline.clamp(_defs.timeout)
+            try:
+                with server.pool.connection(timeout) as conn:
+                    try:
+                        with metrics.timer('vds_ldap_seconds', server=server.name, op='bind'), \
+                                tracing.span('ldap', 'bind', server=server.name):
+                            conn.simple_bind_s(username_full, password)
+                    except ldap.INVALID_CREDENTIALS as e:
+                        raise AuthError('Authentication failed: user={}, msg={}'.format(username, e))
+                    if server.service is None:
+                        return _search(server, conn, username, timeout)
+                with server.service.connection(timeout) as conn:
+                    return _search(server, conn, username, timeout)
+            except ldap.SIZELIMIT_EXCEEDED:
+                raise AuthError('Authentication failed: user={}, msg=ambiguous user'.format(username))
+            except ldap.TIMEOUT as e:
+                raise _timeout_error(e, timeout, 'LDAP authentication')
+            except ldap.SERVER_DOWN as e:
+                if attempt == 0:
+                    log.info("LDAP connection to [{}] dropped, retrying: {}".format(server.name, e))
+                    continue
+                raise LdapError(str(e))
+            except _CONNECTION_ERRORS as e:
+                raise LdapError(str(e))
+            except ldap.LDAPError as e:
+                # only the rejection of the user's bind tells about the password
+                raise LdapError("LDAP request to [{}] failed: {}".format(server.name, e))
+
+
+def _timeout_error(error, timeout, what):
+    """Return the error to raise for an LDAP timeout.
+
+    A timeout shortened to fit the request deadline is put down to the
+    deadline rather than to the server, so that it neither counts as a
+    failure of the circuit breaker nor marks the server unhealthy.
+    """
+    if timeout < _defs.timeout:
+        return DeadlineExceededError("{} cut short by the request deadline: {}".format(what, error))
+    return LdapError(str(error))
+
+
+def _search(server, conn, username, timeout):
+    """Search the entry of a user, caching its groups if group lookup is enabled.
+
+    Raises:
+        AuthError: if more than one entry matches the user.
+    """
+    search_filter = "userPrincipalName={}".format(
+            ldap.filter.escape_filter_chars("{}@{}".format(username, _defs.domain)))
+    with metrics.timer('vds_ldap_seconds', server=server.name, op='search'), \
+            tracing.span('ldap', 'search', server=server.name):
+        result = conn.search_ext_s(_defs.search_base, ldap.SCOPE_SUBTREE, search_filter,
+                attrlist=_defs.attributes, timeout=timeout, sizelimit=_defs.size_limit)
+    entries = [attrs for dn, attrs in result if dn is not None]  # skip referrals
+    if len(entries) > 1:
+        raise AuthError('Authentication failed: user={}, msg=ambiguous user'.format(username))
+    if _defs.group_attribute is not None:
+        groups = entries[0].get(_defs.group_attribute, []) if entries else []
+        with _defs.groups_lock:
+            _defs.groups[username] = (time.time() + _defs.group_ttl, groups)
+    return result
+
+
+def groups(username, deadline=None):
+    """Retrieves the DNs of the groups a user is member of.
+
+    Memberships are cached for `ttl` seconds from the last authentication or
+    lookup of the user. Expired memberships are looked up again with the
+    service account, if one is configured, failing over like `auth()`.
+
+    Returns:
+        list: group DNs, or None if group lookup is disabled or the groups of
+        the user are not known.
+
+    Raises:
+        LdapError: if all servers are unreachable or timed out.
+        BackendUnavailableError: if the circuit breakers of all servers are open.
+        DeadlineExceededError: if the deadline has passed.
+    """
+    if _defs.group_attribute is None:
+        return None
+    with _defs.groups_lock:
+        expiry, cached = _defs.groups.get(username, (0, None))
+    if expiry > time.time() or not any(s.service is not None for s in _defs.servers):
+        return cached if expiry > time.time() else None
 
+    deadline = deadline or resilience.current()
+    error = None
+    for server in _ordered():
+        if server.service is None:
+            continue
+        if deadline is not None:
+            deadline.check('LDAP group lookup')
+        timeout = resilience.clamp(_defs.timeout) if deadline is None else deadline.clamp(_defs.timeout)
+        try:
+            with server.breaker.guard((LdapError,)):
+                try:
+                    with server.service.connection(timeout) as conn:
+                        _search(server, conn, username, timeout)
+                except ldap.TIMEOUT as e:
+                    raise _timeout_error(e, timeout, 'LDAP group lookup')
+                except _CONNECTION_ERRORS as e:
+                    raise LdapError(str(e))
+                except (ldap.LDAPError, AuthError) as e:
+                    log.warning("Unable to look up groups of user [{}]: {}".format(username, e))
+                    return None
+        except (LdapError, BackendUnavailableError) as e:
+            metrics.inc('vds_ldap_errors_total', server=server.name, op='groups')
+            server.failed(e)
+            error = e
+            continue
+        with _defs.groups_lock:
+            return _defs.groups.get(username, (0, None))[1]
+    raise error
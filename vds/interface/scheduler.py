@@ -0,0 +1,182 @@
+import collections
+import logging
+import threading
+import time
+
+from vds.exceptions import XapiOperationError
+
+
+log = logging.getLogger(__name__)
+
+
+class _Request(object):
+    """A queued or running VM start."""
+
+    def __init__(self, user, vm_uuid, host):
+        self.user = user
+        self.vm_uuid = vm_uuid
+        self.host = host
+        self.queued_at = time.time()
+        self.started_at = None
+
+
+class StartScheduler(object):
+    """Admission control for VM starts.
+
+    Starting hundreds of VMs at once saturates the storage of the pool and
+    slows down every boot. The scheduler limits the number of concurrent
+    starts, globally and per home host (VM affinity), and queues the rest.
+    Each user has a FIFO queue and users are served round-robin, so a user
+    starting many VMs cannot starve the others. Repeated starts of a queued
+    or running VM are merged.
+
+    A start holds its slot until its task finishes (see `TaskTracker`), or
+    for at most `slot_timeout` seconds.
+    """
+
+    def __init__(self, client, max_concurrent=10, per_host=4, slot_timeout=600.0):
+        """Build the scheduler.
+
+        Args:
+            client (XapiClient): the client starting the VMs.
+            max_concurrent (int): maximum number of concurrent starts.
+            per_host (int): maximum number of concurrent starts per home host.
+            slot_timeout (float): seconds after which a start no longer counts
+                against the limits, even if its task is still pending.
+        """
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.per_host = per_host
+        self.slot_timeout = slot_timeout
+        self._queues = collections.OrderedDict()  # user -> deque of _Request, in serving order
+        self._queued = {}   # VM uuid -> queued _Request
+        self._running = {}  # VM uuid -> running _Request
+        self._hosts = collections.Counter()  # host ref -> running starts
+        self._lock = threading.Lock()
+        client.tasks.add_listener(self._on_task_finished)
+
+    def submit(self, user, vm_uuid):
+        """Queue the start of a VM.
+
+        Args:
+            user (str): the user requesting the start.
+            vm_uuid (str): VM uuid.
+
+        Returns:
+            int: queue position, 0 if the start has been submitted to XAPI.
+
+        Raises:
+            XapiOperationError: if VM is not powered off.
+            XapiError: when encountered unexpect XAPI errors.
+        """
+        with self._lock:
+            known = vm_uuid in self._queued or vm_uuid in self._running
+        if not known:
+            info = self.client.get_vm_info(vm_uuid)
+            if info['power_state'] != 'Halted':
+                raise XapiOperationError("VM [{}] is not in 'Halted' state."
+                        " Start operation is ignored.".format(vm_uuid))
+            host = self.client.get_affinity(vm_uuid)
+            with self._lock:
+                if vm_uuid not in self._queued and vm_uuid not in self._running:
+                    request = _Request(user, vm_uuid, host)
+                    self._queued[vm_uuid] = request
+                    self._queues.setdefault(user, collections.deque()).append(request)
+
+        self._dispatch()
+        return self.position(vm_uuid)
+
+    def position(self, vm_uuid):
+        """Return the queue position of a VM start.
+
+        Returns:
+            int: 1-based position in the queue, 0 if the start is running,
+            None if the VM is neither queued nor starting.
+        """
+        with self._lock:
+            if vm_uuid in self._running:
+                return 0
+            if vm_uuid not in self._queued:
+                return None
+            for i, request in enumerate(self._order()):
+                if request.vm_uuid == vm_uuid:
+                    return i + 1
+
+    def stats(self):
+        """Return the number of queued and running starts."""
+        with self._lock:
+            return {'queued': len(self._queued), 'running': len(self._running)}
+
+    def _order(self):
+        """Yield queued requests in the order they would be served: round-robin over users."""
+        queues = [list(q) for q in self._queues.values()]
+        depth = 0
+        while queues:
+            remaining = []
+            for q in queues:
+                yield q[depth]
+                if len(q) > depth + 1:
+                    remaining.append(q)
+            queues = remaining
+            depth += 1
+
+    def _admit(self):
+        """Move admissible requests from the queues to running, in serving order."""
+        self._expire()
+        admitted = []
+        skipped = 0
+        while self._queues and len(self._running) < self.max_concurrent and skipped < len(self._queues):
+            user, queue = self._queues.popitem(last=False)
+            request = queue[0]
+            if request.host is not None and self._hosts[request.host] >= self.per_host:
+                # home host is busy, serve the next user and try again later
+                self._queues[user] = queue
+                skipped += 1
+                continue
+            queue.popleft()
+            if queue:
+                self._queues[user] = queue
+            del self._queued[request.vm_uuid]
+            request.started_at = time.time()
+            self._running[request.vm_uuid] = request
+            if request.host is not None:
+                self._hosts[request.host] += 1
+            admitted.append(request)
+            skipped = 0
+        return admitted
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                admitted = self._admit()
+            if not admitted:
+                return
+            for request in admitted:
+                log.info("Starting VM [{}] for user [{}], waited {:.1f}s.".format(
+                    request.vm_uuid, request.user, request.started_at - request.queued_at))
+                try:
+                    self.client.start_vm(request.vm_uuid)
+                except Exception as e:
+                    log.warning("Unable to start VM [{}]: {}".format(request.vm_uuid, e))
+                    self._release(request.vm_uuid)
+
+    def _release(self, vm_uuid):
+        with self._lock:
+            request = self._running.pop(vm_uuid, None)
+            if request is not None and request.host is not None:
+                self._hosts[request.host] -= 1
+        return request is not None
+
+    def _expire(self):
+        expired = time.time() - self.slot_timeout
+        for vm_uuid, request in self._running.items():
+            if request.started_at < expired:
+                log.warning("Start of VM [{}] exceeded {}s, releasing its slot.".format(
+                    vm_uuid, self.slot_timeout))
+                del self._running[vm_uuid]
+                if request.host is not None:
+                    self._hosts[request.host] -= 1
+
+    def _on_task_finished(self, task):
+        if self._release(task.vm_uuid):
+            self._dispatch()
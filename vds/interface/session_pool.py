@@ -0,0 +1,168 @@
+import contextlib
+import httplib
+import logging
+import threading
+import time
+import xmlrpclib
+import Queue
+
+from vds import resilience
+from vds.driver import XenAPI
+from vds.driver.transport import KeepAliveTransport
+from vds.exceptions import XapiError, DeadlineExceededError
+
+
+log = logging.getLogger(__name__)
+
+_CONNECTION_ERRORS = (IOError, httplib.HTTPException, xmlrpclib.Error)
+
+
+class SessionPool(object):
+    """A pool of authenticated XAPI sessions.
+
+    `XenAPI.Session` re-logs in on `SESSION_INVALID` by mutating itself, so a
+    session must not be shared by concurrent requests. The pool hands each
+    thread a session of its own and takes it back afterwards. Sessions are
+    created lazily up to `size`, and those idle for longer than
+    `check_interval` are probed before reuse and replaced if broken.
+
+    All calls through the pool are guarded by the circuit breaker of the
+    XAPI server, see `vds.resilience`. Timeouts cut short by the request
+    deadline are not counted as failures of the server.
+    """
+
+    def __init__(self, url, size=4, transport=None, check_interval=60.0, checkout_timeout=30.0):
+        """Build the pool.
+
+        Args:
+            url (str): XAPI url.
+            size (int): maximum number of sessions.
+            transport (dict): keyword arguments of `KeepAliveTransport`,
+                shared by all sessions of the pool.
+            check_interval (float): seconds a session may stay idle before it
+                is probed on checkout.
+            checkout_timeout (float): seconds to wait for a session when all
+                of them are in use.
+        """
+        options = {'pool_size': size}
+        options.update(transport or {})
+        self.url = url
+        self.size = size
+        self.check_interval = check_interval
+        self.checkout_timeout = checkout_timeout
+        self._transport = KeepAliveTransport(**options)
+        self._credentials = None
+        self._idle = Queue.LifoQueue()  # (session, released at)
+        self._created = 0
+        self._lock = threading.Lock()
+        self.breaker = resilience.breaker('xapi:{}'.format(url))
+
+    def login(self, username, password):
+        """Authenticate the first session, validating the credentials.
+
+        Raises:
+            XenAPI.Failure: if XAPI rejected the login.
+            IOError: if XAPI is unreachable.
+        """
+        self._credentials = (username, password)
+        with self._lock:
+            self._created += 1
+        try:
+            session = self._new_session()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        self._checkin(session)
+
+    @contextlib.contextmanager
+    def session(self):
+        """Check out a session for the duration of the `with` block.
+
+        A session is discarded instead of returned if the block raises a
+        connection or protocol error, which is translated to `XapiError`.
+        API level errors (`XenAPI.Failure`) and exceptions of the caller leave
+        the session usable.
+
+        Raises:
+            XapiError: if no session became available within `checkout_timeout`,
+                or on connection or protocol errors.
+            BackendUnavailableError: if the circuit breaker of the server is open.
+        """
+        self.breaker.before()
+        try:
+            session = self._checkout()
+        except _CONNECTION_ERRORS as e:
+            self.breaker.failure()
+            raise XapiError("Unable to connect to XAPI server: {}".format(e))
+        except BaseException:
+            self.breaker.abort()
+            raise
+
+        try:
+            yield session
+        except _CONNECTION_ERRORS as e:
+            self._discard(session)
+            self.breaker.failure()
+            raise XapiError("XAPI connection error: {}".format(e))
+        except DeadlineExceededError:
+            self._checkin(session)
+            self.breaker.abort()
+            raise
+        except BaseException:
+            self._checkin(session)
+            self.breaker.success()
+            raise
+        else:
+            self._checkin(session)
+            self.breaker.success()
+
+    def _checkout(self):
+        try:
+            session, released_at = self._idle.get_nowait()
+        except Queue.Empty:
+            with self._lock:
+                grow = self._created < self.size
+                if grow:
+                    self._created += 1
+            if grow:
+                try:
+                    return self._new_session()
+                except BaseException:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                session, released_at = self._idle.get(timeout=resilience.clamp(self.checkout_timeout))
+            except Queue.Empty:
+                raise XapiError("No XAPI session available after {}s.".format(self.checkout_timeout))
+
+        if time.time() - released_at > self.check_interval and not self._healthy(session):
+            self._discard(session)
+            return self._checkout()
+        return session
+
+    def _checkin(self, session):
+        self._idle.put((session, time.time()))
+
+    def _discard(self, session):
+        with self._lock:
+            self._created -= 1
+        try:
+            session.xenapi.session.logout()
+        except Exception:
+            pass
+
+    def _new_session(self):
+        session = XenAPI.Session(self.url, transport=self._transport)
+        session.xenapi.login_with_password(*self._credentials)
+        return session
+
+    def _healthy(self, session):
+        # an expired session is re-logged in by `XenAPI.Session` itself
+        try:
+            session.xenapi.pool.get_all()
+            return True
+        except Exception as e:
+            log.warning("Discarding broken XAPI session: {}".format(e))
+            return False
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Task(object):
+    """State of an asynchronous XAPI operation on a VM.
+
+    Attributes:
+        vm_uuid (str): uuid of the VM operated on.
+        ref (str): XAPI task ref.
+        status (str): pending, success, failure, cancelling or cancelled.
+        progress (float): 0.0 to 1.0.
+        error (list): XAPI `error_info` of a failed task.
+        finished_at (float): time the task left the pending state, or None.
+    """
+
+    def __init__(self, vm_uuid, ref):
+        self.vm_uuid = vm_uuid
+        self.ref = ref
+        self.status = 'pending'
+        self.progress = 0.0
+        self.error = []
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def pending(self):
+        return self.finished_at is None
+
+
+class TaskTracker(object):
+    """Follows the progress of asynchronous VM operations.
+
+    Task records are fed by XAPI events (`on_event()`, wired to the inventory
+    event stream) if available, and by a polling thread started on demand,
+    which is the only source without an event stream and a safety net with
+    one. Finished tasks are destroyed on the server and kept locally for
+    `retention` seconds so that clients can still query them.
+    """
+
+    def __init__(self, get_record, destroy, poll_interval=2.0, retention=300.0):
+        """Build the tracker.
+
+        Args:
+            get_record (callable): returns the XAPI record of a task ref.
+            destroy (callable): destroys a task ref on the server.
+            poll_interval (float): seconds between polls of pending tasks.
+            retention (float): seconds finished tasks are kept.
+        """
+        self.get_record = get_record
+        self.destroy = destroy
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._tasks = {}  # VM uuid -> Task
+        self._refs = {}   # task ref -> Task
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._poller = None
+
+    def add_listener(self, listener):
+        """Register `listener(task)`, called whenever a task finishes."""
+        self._listeners.append(listener)
+
+    def track(self, vm_uuid, ref):
+        """Start tracking the task `ref` operating on VM `vm_uuid`.
+
+        Returns:
+            Task: the tracked task.
+        """
+        task = Task(vm_uuid, ref)
+        with self._cond:
+            self._purge()
+            self._tasks[vm_uuid] = task
+            self._refs[ref] = task
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='xapi-tasks')
+                self._poller.daemon = True
+                self._poller.start()
+        return task
+
+    def get(self, vm_uuid):
+        """Return the latest task of VM `vm_uuid`, or None."""
+        with self._cond:
+            return self._tasks.get(vm_uuid)
+
+    def wait(self, vm_uuid, timeout):
+        """Wait up to `timeout` seconds for the task of VM `vm_uuid` to finish.
+
+        Returns:
+            Task: the latest task of the VM, or None.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            task = self._tasks.get(vm_uuid)
+            while task is not None and task.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                task = self._tasks.get(vm_uuid)
+            return task
+
+    def on_event(self, event):
+        """Update tasks from an XAPI `task` class event."""
+        if event['operation'] != 'del' and 'snapshot' in event:
+            self.update(event['ref'], event['snapshot'])
+
+    def update(self, ref, record):
+        """Update the task `ref` from its XAPI record."""
+        with self._cond:
+            task = self._refs.get(ref)
+            if task is None or not task.pending:
+                return
+            task.status = record['status']
+            task.progress = record['progress']
+            task.error = record['error_info']
+            if task.status in ('pending', 'cancelling'):
+                return
+            task.finished_at = time.time()
+            del self._refs[ref]
+            self._cond.notify_all()
+
+        if task.status == 'success':
+            log.info("Task [{}] on VM [{}] succeeded.".format(ref, task.vm_uuid))
+        else:
+            log.warning("Task [{}] on VM [{}] {}: {}".format(ref, task.vm_uuid, task.status, task.error))
+        for listener in self._listeners:
+            listener(task)
+        try:
+            self.destroy(ref)
+        except Exception as e:
+            log.warning("Unable to destroy task [{}]: {}".format(ref, e))
+
+    def _purge(self):
+        expired = time.time() - self.retention
+        for vm_uuid, task in self._tasks.items():
+            if not task.pending and task.finished_at < expired:
+                del self._tasks[vm_uuid]
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._cond:
+                refs = list(self._refs)
+            for ref in refs:
+                try:
+                    self.update(ref, self.get_record(ref))
+                except Exception as e:
+                    log.warning("Unable to poll task [{}]: {}".format(ref, e))
@@ -1,7 +1,16 @@
+import collections
 import logging
+import threading
+import time
 
+from vds import metrics
 from vds.driver import XenAPI
 from vds.exceptions import *
+from vds.interface.federation import Federation
+from vds.interface.inventory import Inventory, OwnerIndex
+from vds.interface.scheduler import StartScheduler
+from vds.interface.session_pool import SessionPool
+from vds.interface.tasks import TaskTracker
 
 
 log = logging.getLogger(__name__)
@@ -22,10 +31,92 @@ def need_auth(func):
 
 _session = None
 
-def init(ip, username, password):
+def init(ip, username, password, sessions=4, bulk_fetch=True, transport=None, inventory=None,
+         scheduler=None):
+    """Initializes the global XAPI client.
+
+    Args:
+        ip (str): XenServer IP.
+        username (str): XenServer root username.
+        password (str): XenServer root password.
+        sessions (int): size of the XAPI session pool.
+        bulk_fetch (bool): fetch VM records with `get_all_records`, see `XapiClient`.
+        transport (dict): keyword arguments of `KeepAliveTransport`.
+        inventory (dict): inventory options, see `XapiClient.enable_inventory()`.
+            The inventory is disabled if omitted or `enabled` is false.
+        scheduler (dict): start scheduler options, see `XapiClient.enable_scheduler()`.
+            Starts are not scheduled if omitted or `enabled` is false.
+    """
+    global _session
+    _session = _build_client(ip, username, password, sessions=sessions, bulk_fetch=bulk_fetch,
+            transport=transport, inventory=inventory, scheduler=scheduler)
+
+
+def init_federation(pools, timeout=10.0, retry_interval=30.0):
+    """Initializes the global XAPI client as a federation of XenServer pools.
+
+    Pools failing to initialize are left out of the federation, and retried
+    in the background until they join it.
+
+    Args:
+        pools (list): dicts of `init()` keyword arguments, one per pool, with
+            an optional `name` (defaults to `ip`).
+        timeout (float): seconds to wait for a pool when querying all of them.
+        retry_interval (float): seconds between retries of the pools left out.
+
+    Raises:
+        XapiError: if no pool could be initialized.
+    """
     global _session
-    _session = XapiClient(ip)
-    _session.login(username, password)
+    clients = collections.OrderedDict()
+    failed = collections.OrderedDict()
+    for conf in pools:
+        conf = dict(conf)
+        name = conf.pop('name', conf['ip'])
+        try:
+            clients[name] = _build_client(**conf)
+            log.info("XenServer pool [{}] initialized.".format(name))
+        except VDSError as e:
+            log.error("XenServer pool [{}] left out: {}".format(name, e))
+            failed[name] = conf
+    if not clients:
+        raise XapiError("No XenServer pool available.")
+    _session = Federation(clients, timeout=timeout)
+    if failed:
+        retrier = threading.Thread(target=_retry_pools, args=(_session, failed, retry_interval),
+                                   name='xapi-pool-retry')
+        retrier.daemon = True
+        retrier.start()
+
+
+def _retry_pools(federation, failed, retry_interval):
+    """Initialize the pools left out of `federation` until all of them joined it."""
+    while failed:
+        time.sleep(retry_interval)
+        for name, conf in failed.items():
+            try:
+                client = _build_client(**conf)
+            except Exception as e:
+                log.warning("XenServer pool [{}] still unavailable: {}".format(name, e))
+                continue
+            federation.add(name, client)
+            del failed[name]
+            log.info("XenServer pool [{}] initialized, joined the federation.".format(name))
+
+
+def _build_client(ip, username, password, sessions=4, bulk_fetch=True, transport=None,
+                  inventory=None, scheduler=None):
+    client = XapiClient(ip, sessions=sessions, bulk_fetch=bulk_fetch, transport=transport)
+    client.login(username, password)
+    if inventory and inventory.get('enabled', False):
+        client.enable_inventory(username, password,
+                timeout=inventory.get('timeout', 30.0),
+                max_staleness=inventory.get('max_staleness', 120.0))
+    if scheduler and scheduler.get('enabled', False):
+        client.enable_scheduler(
+                max_concurrent=scheduler.get('max_concurrent', 10),
+                per_host=scheduler.get('per_host', 4))
+    return client
 
 
 def current_session():
@@ -34,24 +125,40 @@ def current_session():
 
 
 class XapiClient(object):
-    """Wrapper class of a xapi session.
+    """Wrapper class of a pool of xapi sessions.
+
+    The client is thread-safe: every operation checks out a session of its own.
 
     Attributes:
         _user_field (str): the field in `other_config` to store the associated user.
+        bulk_fetch (bool): whether VM lookups use `get_all_records`. Cleared
+            automatically if the server does not support it.
     """
 
     # the username to which a VM is associated
     _user_field = 'XenCenter.CustomFields.owner'
 
-    def __init__(self, ip):
+    def __init__(self, ip, sessions=4, bulk_fetch=True, transport=None):
         """Build the client with XenServer IP address.
 
         Args:
             ip (str): XenServer IP.
+            sessions (int): maximum number of concurrent XAPI sessions.
+            bulk_fetch (bool): fetch all VM and guest metrics records in one
+                call each instead of one call per VM.
+            transport (dict): keyword arguments of `KeepAliveTransport`,
+                e.g. `pool_size`, `connect_timeout` and `read_timeout`.
         """
         self.url = "http://{}".format(ip)
-        self.session = XenAPI.Session(self.url)
+        self.sessions = SessionPool(self.url, size=sessions, transport=transport)
         self.ready = False
+        self.bulk_fetch = bulk_fetch
+        self.inventory = None
+        self.max_staleness = None
+        self.tasks = TaskTracker(self._get_task_record, self._destroy_task)
+        self.scheduler = None
+        # starts of a VM are serialized, VMs share locks by uuid hash
+        self._start_locks = [threading.Lock() for _ in range(64)]
 
     def login(self, username, password):
         """Authenticate with XAPI server.
@@ -67,7 +174,7 @@ class XapiClient(object):
             XapiError: when encountered unexpect XAPI errors.
         """
         try:
-            self.session.xenapi.login_with_password(username, password)
+            self.sessions.login(username, password)
             self.ready = True
         except XenAPI.Failure as e:
             if 'SESSION_AUTHENTICATION_FAILED' in e.details:
@@ -78,32 +185,91 @@ class XapiClient(object):
             raise XapiError("Unable to connect to XAPI server: {}".format(e))
 
 
-    def _get_vm_info(self, vm_ref):
-        vm = self.session.xenapi.VM.get_record(vm_ref)
-        vgm_ref = self.session.xenapi.VM.get_guest_metrics(vm_ref)
+    def enable_inventory(self, username, password, timeout=30.0, max_staleness=120.0):
+        """Answer VM queries from an event-driven in-memory inventory.
+
+        Args:
+            username (str): XenServer root username, for the event session.
+            password (str): XenServer root password, for the event session.
+            timeout (float): seconds a single `event.from` call may block.
+            max_staleness (float): queries fall back to XAPI when the inventory
+                has not been confirmed current for this many seconds.
+
+        Raises:
+            XapiError: if the initial load failed.
+        """
+        inventory = Inventory(self.url, username, password, XapiClient._user_field,
+                listeners={'task': self.tasks.on_event}, timeout=timeout)
+        try:
+            inventory.start()
+        except (XenAPI.Failure, IOError) as e:
+            raise XapiError("Unable to load VM inventory: {}".format(e))
+        self.inventory = inventory
+        self.max_staleness = max_staleness
+        # task events arrive through the inventory, polling is only a safety net
+        self.tasks.poll_interval = max(self.tasks.poll_interval, timeout)
+
+    def enable_scheduler(self, max_concurrent=10, per_host=4):
+        """Queue VM starts requested with `request_start()` behind a `StartScheduler`.
 
-        vm_info = {}
+        Args:
+            max_concurrent (int): maximum number of concurrent starts.
+            per_host (int): maximum number of concurrent starts per home host.
+        """
+        self.scheduler = StartScheduler(self, max_concurrent=max_concurrent, per_host=per_host)
+        metrics.register(self._collect_starts)
 
-        uuid = vm['uuid']
-        vm_name = vm['name_label']
-        power_state = vm['power_state']
+    def _collect_starts(self):
+        return [('vds_vm_starts', {'pool': self.url, 'state': state}, count)
+                for state, count in self.scheduler.stats().items()]
 
-        vm_info = {
-            'power_state': power_state,
-            'name': vm_name,
-            'ip': None,
-            'os': {},
-            'uuid': uuid,
-        }
+    def staleness(self):
+        """Seconds since the inventory was last confirmed current.
 
+        Returns:
+            float, or None if VM queries are not answered from the inventory.
+        """
+        if self.inventory is None:
+            return None
+        return self.inventory.staleness()
+
+    def _use_inventory(self):
+        if self.inventory is None or not self.inventory.ready:
+            return False
+        staleness = self.inventory.staleness()
+        if staleness > self.max_staleness:
+            log.warning("Inventory is {:.0f}s stale, querying XAPI directly.".format(staleness))
+            return False
+        return True
+
+    def _get_vm_info(self, session, vm_ref):
+        vm = session.xenapi.VM.get_record(vm_ref)
+        vgm_ref = vm['guest_metrics']
+        vgm = None
         if vgm_ref != 'OpaqueRef:NULL':
-            vgm = self.session.xenapi.VM_guest_metrics.get_record(vgm_ref)
-            ip = vgm['networks']['0/ip'] if '0/ip' in vgm['networks'].keys() else ''
-            os = vgm['os_version']
-            vm_info['ip'] = ip
-            vm_info['os'] = os
+            vgm = session.xenapi.VM_guest_metrics.get_record(vgm_ref)
+
+        return _vm_info(vm, vgm)
+
+    def _get_vms_bulk(self, session, predicate):
+        """Fetch VMs matching `predicate` with a constant number of XAPI calls.
 
-        return vm_info
+        Returns:
+            list: VM info of matching VMs, or None if `get_all_records` is
+            not supported by the server.
+        """
+        try:
+            vms = session.xenapi.VM.get_all_records()
+            vgms = session.xenapi.VM_guest_metrics.get_all_records()
+        except XenAPI.Failure as e:
+            if 'MESSAGE_METHOD_UNKNOWN' not in e.details:
+                raise
+            log.warning("XAPI server does not support get_all_records, bulk fetch disabled.")
+            self.bulk_fetch = False
+            return None
+
+        return [_vm_info(vm, vgms.get(vm['guest_metrics']))
+                for vm in vms.values() if predicate(vm)]
 
     @need_auth
     def get_vms_by_user(self, username):
@@ -130,19 +296,76 @@ class XapiClient(object):
                     } (may be empty if xentools not functioning properly)
                 }
         """
-        user_vms = []
+        if self._use_inventory():
+            return [_vm_info(vm, vgm) for vm, vgm in self.inventory.owned_by(username)]
 
-        all_vm_ref = self.session.xenapi.VM.get_all()
-        for vm_ref in all_vm_ref:
-            other_config = self.session.xenapi.VM.get_other_config(vm_ref)
-            if XapiClient._user_field not in other_config.keys():
-                continue
+        owned = lambda vm: vm['other_config'].get(XapiClient._user_field) == username
+        try:
+            with self.sessions.session() as session:
+                if self.bulk_fetch:
+                    user_vms = self._get_vms_bulk(session, owned)
+                    if user_vms is not None:
+                        return user_vms
+
+                user_vms = []
+
+                all_vm_ref = session.xenapi.VM.get_all()
+                for vm_ref in all_vm_ref:
+                    other_config = session.xenapi.VM.get_other_config(vm_ref)
+                    if XapiClient._user_field not in other_config.keys():
+                        continue
+
+                    if other_config[XapiClient._user_field] == username:
+                        user_vm = self._get_vm_info(session, vm_ref)
+                        user_vms.append(user_vm)
+
+                return user_vms
+        except XenAPI.Failure as e:
+            raise XapiError("Unexpected XAPI error: {}".format(e))
+
+    @need_auth
+    def get_vm_changes(self, username, since=None):
+        """Retrieve the VMs of a user changed since a version of the inventory.
 
-            if other_config[XapiClient._user_field] == username:
-                user_vm = self._get_vm_info(vm_ref)
-                user_vms.append(user_vm)
+        Args:
+            username (str): name of a virtual desktop user.
+            since (str): `version` returned by an earlier call, None for all VMs.
 
-        return user_vms
+        Returns:
+            dict: `vms`, VM info (see `get_vms_by_user()`) of the VMs changed;
+            `removed`, uuids of the VMs the user no longer owns; `version`, to
+            pass as `since` next time, None if VM queries are not answered
+            from the inventory; `full`, whether `since` was not usable and
+            `vms` lists all VMs of the user.
+        """
+        if self._use_inventory():
+            pairs, removed, version, full = self.inventory.changes(username, since)
+            return {'vms': [_vm_info(*pair) for pair in pairs], 'removed': removed,
+                    'version': version, 'full': full}
+        return {'vms': self.get_vms_by_user(username), 'removed': [], 'version': None, 'full': True}
+
+    @need_auth
+    def top_owners(self, n=10):
+        """List the users owning the most VMs, for capacity reports.
+
+        Args:
+            n (int): maximum number of users to list, all if None.
+
+        Returns:
+            list: (username, VM count) tuples, most VMs first.
+        """
+        if self._use_inventory():
+            return self.inventory.top_owners(n)
+
+        index = OwnerIndex(XapiClient._user_field)
+        try:
+            with self.sessions.session() as session:
+                records = session.xenapi.VM.get_all_records()
+            for ref, vm in records.items():
+                index.update(ref, vm)
+        except XenAPI.Failure as e:
+            raise XapiError("Unexpected XAPI error: {}".format(e))
+        return index.top(n)
 
     @need_auth
     def get_vm_info(self, vm_uuid):
@@ -157,29 +380,62 @@ class XapiClient(object):
         Raises:
             XapiError: when encountered unexpect XAPI errors.
         """
+        if self._use_inventory():
+            pair = self.inventory.get_by_uuid(vm_uuid)
+            if pair is not None:
+                return _vm_info(*pair)
+
         try:
-            vm_ref = self.session.xenapi.VM.get_by_uuid(vm_uuid)
-            vm_info = self._get_vm_info(vm_ref)
+            with self.sessions.session() as session:
+                vm_ref = session.xenapi.VM.get_by_uuid(vm_uuid)
+                vm_info = self._get_vm_info(session, vm_ref)
             return vm_info
-        except XAPI.Failure as e:
+        except XenAPI.Failure as e:
             raise XapiError("Unexpected XAPI error: {}".format(e))
 
+    def _get_task_record(self, task_ref):
+        with self.sessions.session() as session:
+            return session.xenapi.task.get_record(task_ref)
+
+    def _destroy_task(self, task_ref):
+        with self.sessions.session() as session:
+            session.xenapi.task.destroy(task_ref)
+
     @need_auth
     def start_vm(self, vm_uuid):
-        """Start the VM.
+        """Start the VM asynchronously.
 
-        Only effective if the VM is in Halted state.
+        Only effective if the VM is in Halted state. Returns as soon as XAPI
+        accepted the operation, follow its progress with `get_task()`.
 
         Args:
             vm_uuid (str): VM uuid.
 
+        Returns:
+            Task: the start task, see `vds.interface.tasks.Task`. If the VM is
+            already being started, the pending task is returned.
+
         Raises:
             XapiOperationError: if VM is not powered off.
             XapiError: when encountered unexpect XAPI errors.
         """
+        with self._start_locks[hash(vm_uuid) % len(self._start_locks)]:
+            # a concurrent start of the VM is seen as the pending task here
+            task = self.tasks.get(vm_uuid)
+            if task is not None and task.pending:
+                return task
+            return self._start_vm(vm_uuid)
+
+    def _start_vm(self, vm_uuid):
         try:
-            vm_ref = self.session.xenapi.VM.get_by_uuid(vm_uuid)
-            self.session.xenapi.VM.start(vm_ref, False, True)
+            with self.sessions.session() as session:
+                vm_ref = session.xenapi.VM.get_by_uuid(vm_uuid)
+                power_state = session.xenapi.VM.get_power_state(vm_ref)
+                if power_state != 'Halted':
+                    raise XapiOperationError("VM [{}] is not in 'Halted' state."
+                            " Start operation is ignored.".format(vm_uuid))
+                task_ref = session.xenapi.Async.VM.start(vm_ref, False, True)
+            return self.tasks.track(vm_uuid, task_ref)
         except XenAPI.Failure as e:
             if 'VM_BAD_POWER_STATE' in e.details:
                 raise XapiOperationError("VM [{}] is not in 'Halted' state."
@@ -187,6 +443,71 @@ class XapiClient(object):
             else:
                 raise XapiError("Unexpected XAPI error: {}".format(e))
 
+    @need_auth
+    def request_start(self, user, vm_uuid):
+        """Start the VM on behalf of a user, through the scheduler if enabled.
+
+        Args:
+            user (str): the user requesting the start.
+            vm_uuid (str): VM uuid.
+
+        Returns:
+            int: queue position, 0 if the start has been submitted to XAPI.
+
+        Raises:
+            XapiOperationError: if VM is not powered off.
+            XapiError: when encountered unexpect XAPI errors.
+        """
+        if self.scheduler is None:
+            self.start_vm(vm_uuid)
+            return 0
+        return self.scheduler.submit(user, vm_uuid)
+
+    def queue_position(self, vm_uuid):
+        """Return the queue position of a VM start, see `StartScheduler.position()`."""
+        if self.scheduler is None:
+            return None
+        return self.scheduler.position(vm_uuid)
+
+    @need_auth
+    def get_affinity(self, vm_uuid):
+        """Retrieve the home host of a VM.
+
+        Returns:
+            str: host ref, or None if the VM has no affinity.
+
+        Raises:
+            XapiError: when encountered unexpect XAPI errors.
+        """
+        if self._use_inventory():
+            pair = self.inventory.get_by_uuid(vm_uuid)
+            if pair is not None:
+                host = pair[0]['affinity']
+                return None if host == 'OpaqueRef:NULL' else host
+
+        try:
+            with self.sessions.session() as session:
+                vm_ref = session.xenapi.VM.get_by_uuid(vm_uuid)
+                host = session.xenapi.VM.get_affinity(vm_ref)
+            return None if host == 'OpaqueRef:NULL' else host
+        except XenAPI.Failure as e:
+            raise XapiError("Unexpected XAPI error: {}".format(e))
+
+    def get_task(self, vm_uuid, wait=0):
+        """Retrieve the latest asynchronous task of a VM.
+
+        Args:
+            vm_uuid (str): VM uuid.
+            wait (float): seconds to wait for a pending task to finish.
+
+        Returns:
+            Task: see `vds.interface.tasks.Task`, None if no task was
+            submitted recently.
+        """
+        if wait > 0:
+            return self.tasks.wait(vm_uuid, wait)
+        return self.tasks.get(vm_uuid)
+
     @need_auth
     def shutdown_vm(self, vm_uuid):
         """Shutdown the VM.
@@ -202,8 +523,9 @@ class XapiClient(object):
             XapiError: when encountered unexpect XAPI errors.
         """
         try:
-            vm_ref = self.session.xenapi.VM.get_by_uuid(vm_uuid)
-            self.session.xenapi.VM.shutdown(vm_ref)
+            with self.sessions.session() as session:
+                vm_ref = session.xenapi.VM.get_by_uuid(vm_uuid)
+                session.xenapi.VM.shutdown(vm_ref)
         except XenAPI.Failure as e:
             if 'VM_BAD_POWER_STATE' in e.details:
                 raise XapiOperationError("VM [{}] is not in appropriate power states for shutdown."
@@ -211,3 +533,25 @@ class XapiClient(object):
             else:
                 raise XapiError("Unexpected XAPI error: {}".format(e))
 
+
+def _vm_info(vm, vgm):
+    """Build the VM info dict (see `XapiClient.get_vms_by_user()`) from records.
+
+    Args:
+        vm (dict): VM record.
+        vgm (dict): VM_guest_metrics record, None if the guest reports no metrics.
+    """
+    vm_info = {
+        'power_state': vm['power_state'],
+        'name': vm['name_label'],
+        'ip': None,
+        'os': {},
+        'uuid': vm['uuid'],
+    }
+
+    if vgm is not None:
+        networks = vgm['networks']
+        vm_info['ip'] = networks['0/ip'] if '0/ip' in networks else ''
+        vm_info['os'] = vgm['os_version']
+
+    return vm_info
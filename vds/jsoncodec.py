@@ -0,0 +1,72 @@
+"""JSON codec of request and response bodies.
+
+The fastest JSON implementation installed is used: ujson, then simplejson,
+then the standard json module. All of them decode UTF-8 encoded bytes
+directly and raise ValueError on malformed documents.
+"""
+import importlib
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+CODECS = ('ujson', 'simplejson', 'json')
+
+
+class _defs(object):
+    name = 'json'
+    loads = staticmethod(json.loads)
+    dumps = staticmethod(json.dumps)
+
+
+def _load(name):
+    module = importlib.import_module(name)
+    if name == 'ujson':
+        # ujson escapes '/' by default, unlike the others
+        return module.loads, lambda obj: module.dumps(obj, escape_forward_slashes=False)
+    return module.loads, lambda obj: module.dumps(obj, separators=(',', ':'))
+
+
+def configure(codec='auto'):
+    """Selects the JSON implementation.
+
+    Args:
+        codec (str): one of `CODECS`, or 'auto' for the first one installed.
+
+    Raises:
+        ValueError: if `codec` is unknown.
+    """
+    if codec != 'auto' and codec not in CODECS:
+        raise ValueError("Unknown JSON codec: {}".format(codec))
+    for name in (CODECS if codec == 'auto' else (codec,)):
+        try:
+            loads, dumps = _load(name)
+        except ImportError:
+            if codec != 'auto':
+                log.warning("JSON codec {} is not installed, using json.".format(name))
+            continue
+        _defs.name, _defs.loads, _defs.dumps = name, staticmethod(loads), staticmethod(dumps)
+        break
+    log.info("JSON codec: {}.".format(_defs.name))
+
+
+def name():
+    return _defs.name
+
+
+def loads(data):
+    """Decodes a JSON document.
+
+    Args:
+        data (str): UTF-8 encoded document.
+
+    Raises:
+        ValueError: if the document is malformed or not UTF-8.
+    """
+    return _defs.loads(data)
+
+
+def dumps(obj):
+    """Encodes `obj` as a compact JSON document."""
+    return _defs.dumps(obj)
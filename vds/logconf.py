@@ -1,31 +1,55 @@
+import atexit
 import logging
+import logging.handlers
+import sys
+import Queue
 
-conf_dict = {
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'simple': {
-            'format': '%(asctime)s [%(levelname)s] %(name)s | %(message)s'
-        }
-    },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': logging.DEBUG,
-            'formatter': 'simple',
-            'stream': 'ext://sys.stdout'
-        },
-        'file': {
-            'class': 'logging.FileHandler',
-            'level': logging.DEBUG,
-            'formatter': 'simple',
-            'filename': 'xsvds.log'
-        }
-    },
-    'loggers': {
-        'vds': {
-            'level': logging.DEBUG,
-            'handlers': ['console', 'file']
-        }
-    }
-}
+from vds.logqueue import QueueHandler, QueueListener, Redactor
+
+_format = '%(asctime)s [%(levelname)s] %(process)d %(name)s | %(message)s'
+
+def configure(filename='xsvds.log', level=logging.DEBUG, max_bytes=None, backup_count=None,
+              queue_size=10000, redact=('password', 'token', 'bind_password')):
+    """Configures the `vds` loggers.
+
+    Records are queued and written to stdout and a log file by a listener
+    thread, see `vds.logqueue`.
+
+    All worker processes append to the same log file, so none of them may
+    rotate it: the file is rotated externally, e.g. by logrotate, and
+    reopened by each worker once it has been moved.
+
+    Args:
+        filename (str): log file.
+        level (int or str): minimum level logged.
+        max_bytes (int): ignored, the log file is rotated externally.
+        backup_count (int): ignored, the log file is rotated externally.
+        queue_size (int): records queued at most, further records are dropped.
+        redact (list): keys whose values are masked in logged documents.
+
+    Returns:
+        QueueHandler: the handler of the `vds` logger.
+    """
+    formatter = logging.Formatter(_format)
+    redactor = Redactor(redact)
+    console = logging.StreamHandler(sys.stdout)
+    watched = logging.handlers.WatchedFileHandler(filename)
+    for handler in (console, watched):
+        handler.setFormatter(formatter)
+        handler.addFilter(redactor)
+
+    queue = Queue.Queue(queue_size)
+    listener = QueueListener(queue, console, watched)
+    listener.start()
+    atexit.register(listener.stop)
+
+    handler = QueueHandler(queue)
+    logger = logging.getLogger('vds')
+    logger.setLevel(level)
+    for old in logger.handlers[:]:
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    if max_bytes is not None or backup_count is not None:
+        logger.warning("logging.max_bytes and logging.backup_count are ignored, "
+                       "rotate {} externally.".format(filename))
+    return handler
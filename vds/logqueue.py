@@ -0,0 +1,95 @@
+"""Logging off the request threads.
+
+Request threads only put log records on a queue (`QueueHandler`); a
+listener thread (`QueueListener`) formats them and writes them to the
+actual handlers. Records should be logged with lazy arguments
+(`log.info("... %s", value)`), so that even formatting happens on the
+listener thread.
+"""
+import collections
+import logging
+import threading
+import Queue
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue, dropping them if the queue is full.
+
+    Attributes:
+        dropped (int): number of records dropped.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """Hands records from a queue to handlers, on a thread of its own."""
+
+    _stop = object()
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Handle the records already queued, then stop the thread."""
+        if self._thread is not None:
+            self.queue.put(self._stop)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class Redactor(logging.Filter):
+    """Masks the values of sensitive keys in the dicts passed as log arguments.
+
+    Dicts are copied rather than changed, as they may still be in use.
+    """
+
+    mask = '***'
+
+    def __init__(self, fields):
+        """
+        Args:
+            fields (list): keys whose values are masked, at any depth.
+        """
+        logging.Filter.__init__(self)
+        self.fields = frozenset(fields)
+
+    def filter(self, record):
+        if isinstance(record.args, tuple):
+            record.args = tuple(self._redact(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = self._redact(record.args)
+        return True
+
+    def _redact(self, value):
+        if isinstance(value, dict):
+            return dict((k, self.mask if k in self.fields else self._redact(v))
+                        for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._redact(v) for v in value)
+        return value
@@ -0,0 +1,244 @@
+"""In-memory metrics, served in the Prometheus text format.
+
+Counters and fixed-bucket latency histograms are kept per process, keyed by
+name and labels. Values kept by other modules, such as cache sizes, are
+read from the collectors given to `register()` at each snapshot. With a `directory`, each worker process writes a snapshot
+of its metrics there every `interval` seconds, and `render()` sums the
+snapshots of all live workers, so any worker can serve the metrics of all
+of them. Whoever can write the directory can forge the metrics: it is
+created private, and not used if it is not a directory owned by the user of
+the process and closed to others.
+
+Metrics are only collected once `init()` has been called.
+"""
+import contextlib
+import errno
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+from vds.driver import XenAPI
+
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'vds_requests_total': ('counter', 'HTTP requests by route and status code.'),
+    'vds_request_seconds': ('histogram', 'HTTP request latency by route.'),
+    'vds_xapi_call_seconds': ('histogram', 'XAPI call latency by method.'),
+    'vds_xapi_call_errors_total': ('counter', 'Failed XAPI calls by method.'),
+    'vds_ldap_seconds': ('histogram', 'LDAP operation latency by server and operation.'),
+    'vds_ldap_errors_total': ('counter', 'Failed LDAP operations by server and operation.'),
+    'vds_ldap_cache_entries': ('gauge', 'Users in the LDAP authentication cache.'),
+    'vds_ldap_cache_lookups_total': ('counter', 'LDAP authentication cache lookups by result.'),
+    'vds_token_cache_entries': ('gauge', 'Tokens in the verified-token cache.'),
+    'vds_token_cache_lookups_total': ('counter', 'Verified-token cache lookups by result.'),
+    'vds_vm_starts': ('gauge', 'VM starts of the start scheduler by pool and state.'),
+}
+
+
+class _defs(object):
+    enabled = False
+    directory = None
+    interval = None
+    counters = {}    # (name, labels) -> value
+    histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+    collectors = []
+    lock = threading.Lock()
+
+
+def init(directory=None, interval=10.0):
+    """Starts collecting metrics.
+
+    Args:
+        directory (str): directory shared by the worker processes, created
+            with mode 0700 if missing. Metrics are not shared if None, or if
+            the directory is not usable.
+        interval (float): seconds between snapshots written to `directory`.
+    """
+    _defs.enabled = True
+    _defs.interval = interval
+    XenAPI.request_hooks.append(_on_xapi_request)
+    if directory is None:
+        return
+    try:
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise OSError(errno.EPERM, "Metrics directory must be a directory of uid {} with mode 0700"
+                          .format(os.getuid()), directory)
+    except OSError as e:
+        log.warning("Metrics are not shared by the workers: {}".format(e))
+        return
+    _defs.directory = directory
+    writer = threading.Thread(target=_write_periodically, name='metrics-writer')
+    writer.daemon = True
+    writer.start()
+
+
+def register(collector):
+    """Registers a collector of values kept by another module.
+
+    Args:
+        collector (callable): returns a list of (name, labels dict, value)
+            tuples, called at each snapshot. The type of each value is the
+            one given in `HELP`, and values are summed over the workers.
+    """
+    with _defs.lock:
+        _defs.collectors.append(collector)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increments a counter."""
+    if not _defs.enabled:
+        return
+    key = _key(name, labels)
+    with _defs.lock:
+        _defs.counters[key] = _defs.counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Records a duration in a histogram."""
+    if not _defs.enabled:
+        return
+    key = _key(name, labels)
+    with _defs.lock:
+        hist = _defs.histograms.get(key)
+        if hist is None:
+            hist = _defs.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+
+
+@contextlib.contextmanager
+def timer(name, errors=None, **labels):
+    """Records the duration of the `with` block in a histogram.
+
+    Args:
+        name (str): histogram name.
+        errors (str): counter incremented if the block raises, if any.
+    """
+    start = time.time()
+    try:
+        yield
+    except BaseException:
+        if errors is not None:
+            inc(errors, **labels)
+        raise
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def _on_xapi_request(method, seconds, error):
+    observe('vds_xapi_call_seconds', seconds, method=method)
+    if error is not None:
+        inc('vds_xapi_call_errors_total', method=method)
+
+
+def snapshot():
+    """Returns the metrics of this process as a JSON-serializable dict."""
+    with _defs.lock:
+        counters = [[name, list(labels), value] for (name, labels), value in _defs.counters.items()]
+        histograms = [[name, list(labels), list(hist)] for (name, labels), hist in _defs.histograms.items()]
+        collectors = list(_defs.collectors)
+    # collectors take locks of their own, they are not called with the metrics lock held
+    for collector in collectors:
+        for name, labels, value in collector():
+            counters.append([name, sorted(labels.items()), value])
+    return {'counters': counters, 'histograms': histograms}
+
+
+def _write_periodically():
+    while True:
+        time.sleep(_defs.interval)
+        _write()
+
+
+def _write():
+    path = os.path.join(_defs.directory, '{}.json'.format(os.getpid()))
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(), f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        log.warning("Unable to write metrics snapshot: {}".format(e))
+
+
+def _snapshots():
+    """Return the snapshots of all live workers, this process' one up to date."""
+    if _defs.directory is None:
+        return [snapshot()]
+    _write()
+    snapshots = []
+    stale = time.time() - 3 * _defs.interval
+    for name in os.listdir(_defs.directory):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(_defs.directory, name)
+        try:
+            if os.path.getmtime(path) < stale:
+                os.remove(path)  # the worker is gone
+                continue
+            with open(path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            continue  # being replaced or removed
+    return snapshots
+
+
+def render():
+    """Renders the metrics of all workers in the Prometheus text format."""
+    counters = {}
+    histograms = {}
+    for snap in _snapshots():
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in snap['histograms']:
+            key = (name, tuple(tuple(l) for l in labels))
+            total = histograms.setdefault(key, [0] * len(hist))
+            for i, v in enumerate(hist):
+                total[i] += v
+
+    lines = []
+    for name in sorted(set(k[0] for k in counters.keys() + histograms.keys())):
+        kind, text = HELP.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for key in sorted(k for k in counters if k[0] == name):
+            lines.append('{}{} {}'.format(name, _labels(key[1]), counters[key]))
+        for key in sorted(k for k in histograms if k[0] == name):
+            hist = histograms[key]
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), hist[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(key[1] + (('le', str(bound)),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(key[1]), repr(hist[-1])))
+            lines.append('{}_count{} {}'.format(name, _labels(key[1]), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
@@ -0,0 +1,235 @@
+"""Background pre-boot of virtual desktops.
+
+Hides boot latency by starting VMs before the user asks for them:
+
+* on login, the halted VMs of the user are queued for start at once;
+* from a learned history of when each user connects to each VM, VMs are
+  started `lead_minutes` ahead of the time slots they are regularly used in.
+
+Starts go through `XapiClient.request_start()`, and thus the start scheduler,
+on a background thread; request threads only enqueue work.
+
+Worker processes sharing a `history_file` merge their history into it under
+a file lock, and only one of them, holding a second lock, makes predictions.
+"""
+import datetime
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+
+from vds.interface import xapi
+from vds.exceptions import VDSError, XapiOperationError
+
+
+log = logging.getLogger(__name__)
+
+_prebooter = None
+
+def init(on_login=True, predictive=False, lead_minutes=15, slot_minutes=30,
+         min_days=3, window_days=28, history_file=None):
+    """Initializes pre-boot, see `Prebooter`."""
+    global _prebooter
+    _prebooter = Prebooter(on_login=on_login, predictive=predictive,
+            lead_minutes=lead_minutes, slot_minutes=slot_minutes, min_days=min_days,
+            window_days=window_days, history_file=history_file)
+    _prebooter.start()
+
+
+def on_login(username, vms):
+    """Notifies a successful login, see `Prebooter.on_login()`. No-op if pre-boot is disabled."""
+    if _prebooter is not None:
+        _prebooter.on_login(username, vms)
+
+
+def record_use(username, vm_uuid):
+    """Notifies a connection to a VM, see `Prebooter.record_use()`. No-op if pre-boot is disabled."""
+    if _prebooter is not None:
+        _prebooter.record_use(username, vm_uuid)
+
+
+class Prebooter(object):
+    """Starts VMs ahead of their use.
+
+    Usage history is kept per user and VM as the days on which the VM was
+    connected to in each time slot, weekdays and weekends apart. A VM is
+    pre-booted for a slot once it was used in that slot on at least
+    `min_days` of the last `window_days` days.
+    """
+
+    def __init__(self, on_login=True, predictive=False, lead_minutes=15, slot_minutes=30,
+                 min_days=3, window_days=28, history_file=None):
+        """Build the pre-booter.
+
+        Args:
+            on_login (bool): start halted VMs of a user on login.
+            predictive (bool): start VMs ahead of their regular use.
+            lead_minutes (int): how long before a slot its VMs are started.
+            slot_minutes (int): length of a time slot.
+            min_days (int): days of use in a slot required for pre-booting.
+            window_days (int): days of history considered.
+            history_file (str): path the history is persisted to, if any.
+        """
+        self.on_login_enabled = on_login
+        self.predictive = predictive
+        self.lead = datetime.timedelta(minutes=lead_minutes)
+        self.slot_minutes = slot_minutes
+        self.min_days = min_days
+        self.window_days = window_days
+        self.history_file = history_file
+        self._history = {}  # user -> VM uuid -> slot -> set of day ordinals
+        self._fired = set()  # (user, VM uuid, slot, day ordinal) already pre-booted
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._leader = None  # file locked while this process makes predictions
+        self._history = self._read()
+
+    def start(self):
+        """Start the worker thread, and the predictor thread if predictive."""
+        worker = threading.Thread(target=self._work, name='preboot')
+        worker.daemon = True
+        worker.start()
+        if self.predictive:
+            predictor = threading.Thread(target=self._predict, name='preboot-predictor')
+            predictor.daemon = True
+            predictor.start()
+
+    def on_login(self, username, vms):
+        """Queue the start of the halted VMs of a user who just logged in.
+
+        Args:
+            username (str): the user.
+            vms (list): the VMs of the user, see `XapiClient.get_vms_by_user()`.
+        """
+        if not self.on_login_enabled:
+            return
+        for vm in vms:
+            if vm['power_state'] == 'Halted':
+                self._queue.put((username, vm['uuid']))
+
+    def record_use(self, username, vm_uuid, when=None):
+        """Record that a user connected to a VM. Only recorded if predictive."""
+        if not self.predictive:
+            return
+        when = when or datetime.datetime.now()
+        with self._lock:
+            days = self._history.setdefault(username, {}).setdefault(vm_uuid, {}) \
+                    .setdefault(self._slot(when), set())
+            if when.toordinal() not in days:
+                days.add(when.toordinal())
+                self._dirty = True
+
+    def due(self, now=None):
+        """Return (user, VM uuid) pairs to pre-boot for the slot starting `lead_minutes` from now."""
+        target = (now or datetime.datetime.now()) + self.lead
+        slot = self._slot(target)
+        today = target.toordinal()
+        first = today - self.window_days
+        due = []
+        with self._lock:
+            self._fired = set(f for f in self._fired if f[3] == today)
+            for user, vms in self._history.items():
+                for vm_uuid, slots in vms.items():
+                    days = slots.get(slot, ())
+                    if sum(1 for d in days if first <= d < today) < self.min_days:
+                        continue
+                    key = (user, vm_uuid, slot, today)
+                    if key not in self._fired:
+                        self._fired.add(key)
+                        due.append((user, vm_uuid))
+        return due
+
+    def _slot(self, when):
+        kind = 'we' if when.weekday() >= 5 else 'wd'
+        return '{}-{}'.format(kind, (when.hour * 60 + when.minute) // self.slot_minutes)
+
+    def _work(self):
+        while True:
+            username, vm_uuid = self._queue.get()
+            try:
+                position = xapi.current_session().request_start(username, vm_uuid)
+                log.info("Pre-booting VM [{}] for user [{}], queue position {}.".format(
+                    vm_uuid, username, position))
+            except XapiOperationError:
+                pass  # already running
+            except VDSError as e:
+                log.warning("Unable to pre-boot VM [{}]: {}".format(vm_uuid, e))
+            except Exception:
+                log.exception("Unexpected error pre-booting VM [{}].".format(vm_uuid))
+
+    def _predict(self):
+        while True:
+            try:
+                self._save()
+                if self._lead():
+                    for pair in self.due():
+                        self._queue.put(pair)
+            except Exception:
+                log.exception("Unexpected error predicting pre-boots.")
+            time.sleep(60)
+
+    def _lead(self):
+        """Tell whether this process makes the predictions of the processes sharing `history_file`."""
+        if not self.history_file or self._leader is not None:
+            return True
+        f = open(self.history_file + '.leader', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        # held until the process exits
+        self._leader = f
+        log.info("Pre-boot predictions are made by process {}.".format(os.getpid()))
+        return True
+
+    def _read(self):
+        """Read the history in `history_file`, empty if there is none."""
+        if not self.history_file or not os.path.exists(self.history_file):
+            return {}
+        try:
+            with open(self.history_file, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning("Unable to load pre-boot history: {}".format(e))
+            return {}
+        return dict(
+            (user, dict((vm_uuid, dict((slot, set(days)) for slot, days in slots.items()))
+                        for vm_uuid, slots in vms.items()))
+            for user, vms in data.items())
+
+    def _save(self):
+        """Merge the history with that of the other processes in `history_file`."""
+        if not self.history_file:
+            return
+        first = datetime.date.today().toordinal() - self.window_days
+        try:
+            with open(self.history_file + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # released on close
+                stored = self._read()
+                with self._lock:
+                    for user, vms in stored.items():
+                        for vm_uuid, slots in vms.items():
+                            for slot, days in slots.items():
+                                self._history.setdefault(user, {}).setdefault(vm_uuid, {}) \
+                                        .setdefault(slot, set()).update(days)
+                    if not self._dirty:
+                        return
+                    data = {}
+                    for user, vms in self._history.items():
+                        for vm_uuid, slots in vms.items():
+                            for slot, days in slots.items():
+                                days.difference_update([d for d in days if d < first])
+                                if days:
+                                    data.setdefault(user, {}).setdefault(vm_uuid, {})[slot] = sorted(days)
+                    self._dirty = False
+                tmp = self.history_file + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmp, self.history_file)
+        except (IOError, OSError) as e:
+            log.warning("Unable to save pre-boot history: {}".format(e))
@@ -0,0 +1,100 @@
+"""Sampling profiler of requests.
+
+One request in every `every`, and the next `pending` requests on demand, are
+run under `cProfile`. Each profile is written in the pstats format to a
+directory per route, the oldest profiles being deleted once the profiles
+take more than `max_bytes`. A request not sampled costs a counter update.
+
+Settings are per worker process.
+"""
+import cProfile
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """Decides which requests are profiled and writes their profiles."""
+
+    def __init__(self, directory, every=0, max_bytes=50 * 1024 * 1024):
+        """
+        Args:
+            directory (str): directory of the profiles, created if missing.
+            every (int): profile one request in `every`, 0 for none.
+            max_bytes (int): disk space the profiles may take.
+        """
+        self.directory = directory
+        self.every = every
+        self.max_bytes = max_bytes
+        self.pending = 0
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def configure(self, every=None, pending=None):
+        """Change the sampling rate and/or the number of requests to profile on demand."""
+        with self._lock:
+            if every is not None:
+                self.every = every
+            if pending is not None:
+                self.pending = pending
+
+    def settings(self):
+        return {'every': self.every, 'pending': self.pending}
+
+    def start(self):
+        """Start profiling the current request if it is sampled.
+
+        Returns:
+            cProfile.Profile: the running profile, or None.
+        """
+        if not self.pending and not self.every:
+            return None
+        with self._lock:
+            if self.pending:
+                self.pending -= 1
+            elif not self.every or next(self._count) % self.every:
+                return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, route):
+        """Stop a profile and write it."""
+        profile.disable()
+        directory = os.path.join(self.directory, re.sub(r'[^\w.-]+', '_', route).strip('_') or 'root')
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profile.dump_stats(os.path.join(directory, '{:.6f}-{}.pstats'.format(time.time(), os.getpid())))
+            self._trim()
+        except (IOError, OSError) as e:
+            log.warning("Unable to write profile: {}".format(e))
+
+    def _trim(self):
+        """Delete the oldest profiles beyond `max_bytes`."""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.pstats'):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((name, path, os.path.getsize(path)))
+                    except OSError:
+                        pass  # deleted meanwhile
+        total = sum(f[2] for f in files)
+        for _, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,199 @@
+"""Request deadlines and circuit breakers for backend calls.
+
+A `Deadline` bounds the total time a request may spend on backend calls. The
+deadline of the current request is kept thread-locally (see `activate()`)
+so that transports and clients can clamp their socket timeouts to it.
+
+A `CircuitBreaker` per backend fails calls fast once the backend failed
+`threshold` times in a row, instead of letting every request wait for it.
+After `reset_timeout` seconds a single probe call is let through (half-open)
+and closes the circuit again if it succeeds.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from vds.exceptions import BackendUnavailableError, DeadlineExceededError
+
+
+log = logging.getLogger(__name__)
+
+
+class Deadline(object):
+    """A point in time by which a request must be done."""
+
+    def __init__(self, timeout):
+        """
+        Args:
+            timeout (float): seconds from now.
+        """
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        """Return the seconds left, negative once expired."""
+        return self.expires_at - time.time()
+
+    def check(self, what):
+        """Raise if the deadline has passed.
+
+        Args:
+            what (str): description of the operation about to start.
+
+        Raises:
+            DeadlineExceededError: if the deadline has passed.
+        """
+        if self.remaining() <= 0:
+            raise DeadlineExceededError("Request deadline exceeded before {}.".format(what))
+
+    def clamp(self, timeout):
+        """Return `timeout` shortened to the remaining time, at least a millisecond."""
+        return max(min(timeout, self.remaining()), 0.001)
+
+
+_local = threading.local()
+
+def current():
+    """Return the deadline of the current thread, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+def activate(deadline):
+    """Set the deadline of the current thread, None to clear it."""
+    _local.deadline = deadline
+
+
+@contextlib.contextmanager
+def scoped(deadline):
+    """Activate `deadline` for the duration of the `with` block."""
+    previous = current()
+    activate(deadline)
+    try:
+        yield deadline
+    finally:
+        activate(previous)
+
+
+def clamp(timeout):
+    """Return `timeout` clamped to the deadline of the current thread, if any."""
+    deadline = current()
+    return timeout if deadline is None else deadline.clamp(timeout)
+
+
+class CircuitBreaker(object):
+    """Fails calls to a backend fast while it is failing.
+
+    Attributes:
+        state (str): closed, open or half-open.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            name (str): backend name, for logs and errors.
+            threshold (int): consecutive failures opening the circuit.
+            reset_timeout (float): seconds before an open circuit lets a probe through.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Admit a call.
+
+        Raises:
+            BackendUnavailableError: if the circuit is open, or half-open with
+            a probe already in flight.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                self._probing = False
+            if self.state == 'half-open' and not self._probing:
+                self._probing = True
+                return
+        raise BackendUnavailableError("Backend [{}] unavailable.".format(self.name))
+
+    def abort(self):
+        """Record a call that did not reach the backend."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        """Record a successful call."""
+        with self._lock:
+            if self.state != 'closed':
+                log.info("Circuit of backend [{}] closed.".format(self.name))
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def failure(self):
+        """Record a failed call."""
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == 'half-open' or self._failures >= self.threshold:
+                if self.state != 'open':
+                    log.warning("Circuit of backend [{}] opened after {} failure(s).".format(
+                        self.name, self._failures))
+                self.state = 'open'
+                self._opened_at = time.time()
+
+    @contextlib.contextmanager
+    def guard(self, failures):
+        """Run the `with` block as a call to the backend.
+
+        Args:
+            failures (tuple): exception types counted as backend failures.
+                `DeadlineExceededError` counts as neither failure nor
+                success, other exceptions count as success since the backend
+                did answer.
+
+        Raises:
+            BackendUnavailableError: see `before()`.
+        """
+        self.before()
+        try:
+            yield
+        except failures:
+            self.failure()
+            raise
+        except DeadlineExceededError:
+            self.abort()
+            raise
+        except BaseException:
+            self.success()
+            raise
+        else:
+            self.success()
+
+
+_breakers = {}
+_breaker_defaults = {'threshold': 5, 'reset_timeout': 30.0}
+_breakers_lock = threading.Lock()
+
+def configure(threshold=5, reset_timeout=30.0):
+    """Set the options of circuit breakers created afterwards."""
+    _breaker_defaults.update(threshold=threshold, reset_timeout=reset_timeout)
+
+
+def breaker(name):
+    """Return the circuit breaker of backend `name`, created on first use."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_breaker_defaults)
+        return _breakers[name]
+
+
+def breakers():
+    """Return all circuit breakers."""
+    with _breakers_lock:
+        return list(_breakers.values())
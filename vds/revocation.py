@@ -0,0 +1,163 @@
+"""Revocation list of tokens, shared by the worker processes.
+
+Revoked tokens are identified by their sha256 digest. Revocations are
+grouped in generations of `window` seconds, each one made of two files:
+
+* `<generation>.bloom`: a Bloom filter, memory-mapped by every worker, so a
+  revocation is visible to all of them at once and a token not revoked is
+  told apart with a few memory reads;
+* `<generation>.log`: the revoked digests, one per line, loaded by a worker
+  only when the filter claims a token is revoked, to rule out false
+  positives.
+
+A token lives at most `window` seconds, so the generations of the current
+and the previous window are checked and older ones are deleted.
+
+Whoever can write the files can revoke or un-revoke tokens: the directory is
+created private, and refused if it is not a directory owned by the user of
+the process and closed to others.
+"""
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class _Generation(object):
+    """The revocations of one window."""
+
+    def __init__(self, directory, number, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.log_path = os.path.join(directory, '{}.log'.format(number))
+        size = bits // 8
+        fd = os.open(os.path.join(directory, '{}.bloom'.format(number)), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.filter = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.digests = set()
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, digest):
+        return [p % self.bits for p in struct.unpack('>{}I'.format(self.hashes), digest[:4 * self.hashes])]
+
+    def might_contain(self, digest):
+        for p in self._positions(digest):
+            if not ord(self.filter[p >> 3]) & (1 << (p & 7)):
+                return False
+        return True
+
+    def contains(self, digest):
+        if not self.might_contain(digest):
+            return False
+        with self.lock:
+            if digest not in self.digests:
+                self._load()
+            return digest in self.digests
+
+    def add(self, digest):
+        with self.lock, os.fdopen(os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(digest.encode('hex') + '\n')
+                f.flush()
+                for p in self._positions(digest):
+                    self.filter[p >> 3] = chr(ord(self.filter[p >> 3]) | (1 << (p & 7)))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            self.digests.add(digest)
+
+    def _load(self):
+        """Read the digests appended to the log since the last load."""
+        try:
+            with open(self.log_path, 'r') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.warning("Unable to read revocation log: {}".format(e))
+            return
+        end = data.rfind('\n') + 1  # leave out a line being written
+        self.digests.update(line.decode('hex') for line in data[:end].split())
+        self.offset += end
+
+    def close(self):
+        self.filter.close()
+
+
+class RevocationList(object):
+    """Revoked token digests, see the module documentation."""
+
+    def __init__(self, directory, window, bits=1 << 20, hashes=4):
+        """
+        Args:
+            directory (str): directory of the files shared by the workers,
+                created with mode 0700 if missing.
+            window (float): lifetime of tokens in seconds.
+            bits (int): size of each Bloom filter. With the default 4 hashes,
+                a million bits keep false positives under 1% for 100,000
+                revocations per window.
+            hashes (int): bits set per revocation, up to 8.
+
+        Raises:
+            OSError: if the directory cannot be created, or is not a directory
+                of the user of the process closed to others.
+        """
+        self.directory = directory
+        self.window = window
+        self.bits = bits
+        self.hashes = hashes
+        self._generations = {}
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise OSError(errno.EPERM, "Revocation directory must be a directory of uid {} with mode 0700"
+                          .format(os.getuid()), directory)
+
+    def _current(self):
+        """Return the generations of the current and the previous window, newest first."""
+        number = int(time.time() // self.window)
+        with self._lock:
+            if number not in self._generations:
+                self._rotate(number)
+            return [self._generations[n] for n in (number, number - 1)]
+
+    def _rotate(self, number):
+        for n in self._generations.keys():
+            if n < number - 1:
+                self._generations.pop(n).close()
+        for n in (number, number - 1):
+            if n not in self._generations:
+                self._generations[n] = _Generation(self.directory, n, self.bits, self.hashes)
+        for name in os.listdir(self.directory):
+            stem = name.split('.')[0]
+            if stem.isdigit() and int(stem) < number - 1:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass  # removed by another worker
+
+    def revoke(self, digest):
+        """Revoke the token of a digest."""
+        self._current()[0].add(digest)
+
+    def revoked(self, digest):
+        """Return whether the token of a digest is revoked."""
+        return any(g.contains(digest) for g in self._current())
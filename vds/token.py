@@ -1,43 +1,156 @@
+"""Issue and verification of user tokens.
+
+A token is a Fernet token, whose own timestamp bounds its validity to
+`_delta` seconds. The encrypted payload is a version byte followed by:
+
+* version 1: the payload, a UTF-8 string;
+* version 2: the payload, compact JSON.
+
+Tokens of the legacy format, a JSON document with `issued_at`,
+`expire_after` and `payload`, are still accepted until they expire.
+
+Tokens can be revoked before they expire, see `vds.revocation`. Until
+`init()` has opened the revocation list, no token is accepted.
+
+`token.secrets` lists the keys, the first of which issues tokens while all
+of them verify tokens, so that a new key can be rolled out before the old
+one is retired. `token.secret` is used if there is no list.
+"""
+import base64
+import collections
+import hashlib
 import json
+import struct
+import threading
 import time
 
 from cryptography import fernet
 
+from vds import metrics
 from vds.config import CONF
 from vds.exceptions import InvalidTokenError
+from vds.revocation import RevocationList
 
 
-_key = CONF['token']['secret']
-_cipher = fernet.Fernet(_key)
+_keys = CONF['token'].get('secrets') or [CONF['token']['secret']]
+_cipher = fernet.MultiFernet([fernet.Fernet(key) for key in _keys])
 _delta = 86400 # one day
 
+_VERSION_STRING = b'\x01'
+_VERSION_JSON = b'\x02'
+
+# verified tokens: sha256 digest -> (expiry, payload), least recently used first
+_cache = collections.OrderedDict()
+_cache_size = CONF['token'].get('cache_size', 10000)
+_cache_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+_revocations = None
+
+
+def init(revocation_dir='revocation', revocation_bits=1 << 20):
+    """Opens the revocation list.
+
+    Args:
+        revocation_dir (str): directory of the revocation list, shared by the
+            worker processes, see `RevocationList`.
+        revocation_bits (int): Bloom filter size of the revocation list.
+
+    Raises:
+        OSError: if the directory cannot be created or is not private.
+    """
+    global _revocations
+    _revocations = RevocationList(revocation_dir, _delta, bits=revocation_bits)
+
+
 def issue(payload):
     """Issues a token containing provided payload."""
-    now = time.time()
-    data = {
-        'issued_at': now,
-        'expire_after': _delta,
-        'payload': payload
-    }
+    if isinstance(payload, basestring):
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        data = _VERSION_STRING + payload
+    else:
+        data = _VERSION_JSON + json.dumps(payload, separators=(',', ':'))
 
-    token = _cipher.encrypt(json.dumps(data))
+    token = _cipher.encrypt(data)
     return token
 
 def verify(token):
-    """Verify the token and retrieves the payload."""
+    """Verify the token and retrieves the payload.
+
+    Verified tokens are cached until they expire, so repeated verifications
+    of a token skip decryption and parsing. Revocation is checked first,
+    cached or not.
+    """
+    digest = hashlib.sha256(token).digest()
+    if _revocations is None:
+        raise InvalidTokenError("Token revocations unavailable.")
+    if _revocations.revoked(digest):
+        raise InvalidTokenError("Token revoked.")
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.pop(digest, None)
+        if cached is not None and cached[0] > now:
+            _cache[digest] = cached
+            _stats['hits'] += 1
+            return cached[1]
+        _stats['misses'] += 1
+
     try:
         data = _cipher.decrypt(token, ttl=_delta)
     except fernet.InvalidToken:
         raise InvalidTokenError("Token corrupted or expired.")
 
+    payload = _decode(data)
+    with _cache_lock:
+        _cache[digest] = (_issued_at(token) + _delta, payload)
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+    return payload
+
+
+def revoke(token):
+    """Revokes a token, in all worker processes."""
+    digest = hashlib.sha256(token).digest()
+    _revocations.revoke(digest)
+    with _cache_lock:
+        _cache.pop(digest, None)
+
+
+def _decode(data):
+    """Decode the payload of a decrypted token."""
+    version, body = data[:1], data[1:]
     try:
-        data = json.loads(data)
-    except ValueError:
+        if version == _VERSION_STRING:
+            return body.decode('utf-8')
+        if version == _VERSION_JSON:
+            return json.loads(body)
+        data = json.loads(data) # legacy format
+    except (ValueError, UnicodeDecodeError):
         raise InvalidTokenError("Token payload deserialization error.")
 
     try:
-        payload = data['payload']
-    except KeyError:
+        return data['payload']
+    except (KeyError, TypeError):
         raise InvalidTokenError("Invalid token payload format.")
 
-    return payload
+
+def _issued_at(token):
+    """Return the timestamp of a verified Fernet token."""
+    return struct.unpack('>Q', base64.urlsafe_b64decode(token)[1:9])[0]
+
+
+def cache_stats():
+    """Returns the number of cached tokens and the hits and misses of the verified-token cache."""
+    with _cache_lock:
+        return dict(_stats, size=len(_cache))
+
+
+def _collect():
+    stats = cache_stats()
+    return [('vds_token_cache_entries', {}, stats['size']),
+            ('vds_token_cache_lookups_total', {'result': 'hit'}, stats['hits']),
+            ('vds_token_cache_lookups_total', {'result': 'miss'}, stats['misses'])]
+
+metrics.register(_collect)
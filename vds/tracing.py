@@ -0,0 +1,201 @@
+"""Request-scoped accounting of backend calls.
+
+A `Trace` is kept thread-locally for the request being handled (see
+`RequestTracing` in `vds.utils`). It counts and times every XAPI call, as
+reported by `XenAPI.request_hooks`, and every LDAP operation wrapped in
+`span()`, as a tree of spans. XML-RPC payload sizes are reported by the
+transport through `add_bytes()`. Threads working for a request are given
+its trace with `scoped()`.
+
+Traces of requests slower than a threshold are written to a trace file, one
+JSON document per line.
+"""
+import collections
+import contextlib
+import json
+import logging
+import logging.handlers
+import threading
+import time
+import Queue
+
+from vds import resilience
+from vds.driver import XenAPI
+from vds.logqueue import QueueHandler, QueueListener
+
+
+log = logging.getLogger(__name__)
+
+
+class Span(object):
+    """A timed backend operation."""
+
+    def __init__(self, kind, name, start, **tags):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.tags = tags
+        self.children = []
+
+    def to_dict(self, origin):
+        d = {'kind': self.kind, 'name': self.name,
+             'start_ms': round((self.start - origin) * 1000, 3),
+             'ms': round((self.duration or 0) * 1000, 3)}
+        d.update(self.tags)
+        if self.children:
+            d['children'] = [c.to_dict(origin) for c in self.children]
+        return d
+
+
+class Trace(object):
+    """The backend calls of a request.
+
+    Attributes:
+        counts (Counter): kind -> number of calls. Spans wrapping other
+            spans, such as an LDAP authentication made of a bind and a
+            search, are not counted themselves.
+        spans (list): top-level spans.
+    """
+
+    def __init__(self, rid=None, route=None):
+        self.rid = rid
+        self.route = route
+        self.started_at = time.time()
+        self.counts = collections.Counter()
+        self.spans = []
+        self._pending_bytes = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, span, parent=None):
+        with self._lock:
+            if parent is not None and not parent.children:
+                # the parent wraps calls of its own, count them instead
+                self.counts[parent.kind] -= 1
+            (parent.children if parent is not None else self.spans).append(span)
+            self.counts[span.kind] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'rid': self.rid,
+                'route': self.route,
+                'at': self.started_at,
+                'ms': round((time.time() - self.started_at) * 1000, 3),
+                'calls': dict(self.counts),
+                'spans': [s.to_dict(self.started_at) for s in self.spans],
+            }
+
+
+_local = threading.local()
+
+def current():
+    """Return the trace of the current thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+def activate(trace):
+    """Set the trace of the current thread, None to clear it."""
+    _local.trace = trace
+    _local.parent = None
+
+
+@contextlib.contextmanager
+def scoped(trace):
+    """Activate `trace` for the duration of the `with` block."""
+    previous, parent = current(), getattr(_local, 'parent', None)
+    activate(trace)
+    try:
+        yield trace
+    finally:
+        _local.trace, _local.parent = previous, parent
+
+
+@contextlib.contextmanager
+def span(kind, name, **tags):
+    """Record the `with` block as a span of the current trace, if any.
+
+    Spans opened inside the block are its children.
+    """
+    trace = current()
+    if trace is None:
+        yield None
+        return
+    s = Span(kind, name, time.time(), **tags)
+    parent = getattr(_local, 'parent', None)
+    trace.add(s, parent)
+    _local.parent = s
+    try:
+        yield s
+    except BaseException as e:
+        s.tags['error'] = type(e).__name__
+        raise
+    finally:
+        s.duration = time.time() - s.start
+        _local.parent = parent
+
+
+def call(deadline, trace, func, *args):
+    """Call `func(*args)` with the deadline and trace of a request activated.
+
+    Used by executor threads working for a request.
+    """
+    with resilience.scoped(deadline), scoped(trace):
+        return func(*args)
+
+
+def add_bytes(sent, received):
+    """Report the payload sizes of the XML-RPC call in progress on this thread."""
+    trace = current()
+    if trace is not None:
+        trace._pending_bytes.value = (sent, received)
+
+
+def _on_xapi_request(method, seconds, error):
+    trace = current()
+    if trace is None:
+        return
+    s = Span('xapi', method, time.time() - seconds)
+    s.duration = seconds
+    sent, received = getattr(trace._pending_bytes, 'value', (None, None))
+    trace._pending_bytes.value = (None, None)
+    if sent is not None:
+        s.tags.update(sent=sent, received=received)
+    if error is not None:
+        s.tags['error'] = type(error).__name__
+    trace.add(s, getattr(_local, 'parent', None))
+
+
+class _defs(object):
+    threshold = None
+    logger = None
+
+
+def init(threshold=1.0, filename='xsvds-trace.log', max_bytes=10 * 1024 * 1024, backup_count=2):
+    """Starts tracing requests.
+
+    Args:
+        threshold (float): seconds above which the trace of a request is written.
+        filename (str): trace file.
+        max_bytes (int): size at which the trace file is rotated.
+        backup_count (int): rotated trace files kept.
+    """
+    _defs.threshold = threshold
+    XenAPI.request_hooks.append(_on_xapi_request)
+
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    queue = Queue.Queue(1000)
+    listener = QueueListener(queue, handler)
+    listener.start()
+    logger = logging.getLogger('vds.trace')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(QueueHandler(queue))
+    _defs.logger = logger
+
+
+def finish(trace):
+    """Write the trace of a finished request if it was slow."""
+    if time.time() - trace.started_at >= _defs.threshold:
+        _defs.logger.info(json.dumps(trace.to_dict()))
@@ -1,30 +1,89 @@
-import random
-import string
-import json
+import itertools
 import logging
+import time
 import falcon
 
-from vds import token
+from vds import jsoncodec, metrics, token, resilience, tracing
 from vds.exceptions import *
 
 
 log = logging.getLogger(__name__)
 
 
+class RequestDeadline(object):
+    """Middleware class bounding the time a request may spend on backend calls.
+
+    Attributes:
+        timeout (float): seconds from the start of a request to its deadline.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def process_request(self, req, resp):
+        """Activates the deadline of the request for the handling thread.
+
+        Args:
+            see falcon documentation.
+        """
+        deadline = resilience.Deadline(self.timeout)
+        req.context['deadline'] = deadline
+        resilience.activate(deadline)
+
+    def process_response(self, req, resp, resource):
+        """Clears the deadline of the request.
+
+        Args:
+            see falcon documentation.
+        """
+        resilience.activate(None)
+
+
+class RequestMetrics(object):
+    """Middleware class counting and timing requests per route and status code."""
+
+    def process_request(self, req, resp):
+        """Records the start time of the request.
+
+        Args:
+            see falcon documentation.
+        """
+        req.context['_started_at'] = time.time()
+
+    def process_response(self, req, resp, resource):
+        """Records the latency and status code of the request.
+
+        Args:
+            see falcon documentation.
+        """
+        route = req.path if resource is not None else 'unmatched' # bounds the label values
+        metrics.observe('vds_request_seconds', time.time() - req.context['_started_at'], route=route)
+        metrics.inc('vds_requests_total', route=route, code=resp.status[:3])
+
+
 class Logger(object):
-    """Middleware class for request/response logging."""
+    """Middleware class for request/response logging.
+
+    Documents are logged as lazy arguments: they are formatted, and their
+    sensitive fields redacted, on the logging thread.
+    """
+
+    _ids = itertools.count(1) # request ids, increasing in each process
+    quiet = ('/v1/heartbeat', '/v1/metrics', '/v1/vms') # paths not logged, polled
+
     def process_request(self, req, resp):
         """Logs incoming requests.
 
         Args:
             see falcon documentation.
         """
-        if req.path == '/v1/heartbeat':
+        if req.path in Logger.quiet:
             return
 
-        rid = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8)) # a random request id
+        rid = next(Logger._ids)
         req.context['_rid'] = rid
-        log.info("**REQUEST**  [{}] from: [{}], route: {}, content: {}".format(rid, req.remote_addr, req.path, req.context['doc']))
+        log.info("**REQUEST**  [%d] from: [%s], route: %s, content: %s",
+                 rid, req.remote_addr, req.path, req.context.get('doc'))
 
     def process_response(self, req, resp, resource, req_succeeded):
         """Logs responses.
@@ -32,13 +91,81 @@ class Logger(object):
         Args:
             see falcon documentation.
         """
-        if req.path == '/v1/heartbeat':
+        if req.path in Logger.quiet:
             return
 
         # `resp.body` is not translated from `context` yet if no exception is raised.
         content = resp.context['result'] if req_succeeded else resp.body
-        log.info("**RESPONSE** [{}] content: {}, succeeded: {}".format(
-            req.context['_rid'], content, req_succeeded))
+        log.info("**RESPONSE** [%d] content: %s, succeeded: %s",
+                 req.context['_rid'], content, req_succeeded)
+
+
+class RequestTracing(object):
+    """Middleware class tracing the backend calls of requests, see `vds.tracing`.
+
+    Attributes:
+        header (bool): whether responses tell the number of backend calls per
+            kind in the `X-VDS-Backend-Calls` header.
+    """
+
+    def __init__(self, header=False):
+        self.header = header
+
+    def process_request(self, req, resp):
+        """Activates a trace for the request.
+
+        Args:
+            see falcon documentation.
+        """
+        trace = tracing.Trace(req.context.get('_rid'), req.path)
+        req.context['trace'] = trace
+        tracing.activate(trace)
+
+    def process_response(self, req, resp, resource):
+        """Clears the trace of the request and writes it if the request was slow.
+
+        Args:
+            see falcon documentation.
+        """
+        tracing.activate(None)
+        trace = req.context.get('trace')
+        if trace is None:
+            return
+        if self.header:
+            resp.set_header('X-VDS-Backend-Calls',
+                    ';'.join('{}={}'.format(k, v) for k, v in sorted(trace.counts.items())) or 'none')
+        tracing.finish(trace)
+
+
+class RequestProfiler(object):
+    """Middleware class profiling sampled requests, see `vds.profiling`.
+
+    Attributes:
+        profiler (Profiler): decides which requests are profiled.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def process_request(self, req, resp):
+        """Starts profiling the request if it is sampled.
+
+        Args:
+            see falcon documentation.
+        """
+        profile = self.profiler.start()
+        if profile is not None:
+            req.context['_profile'] = profile
+
+    def process_response(self, req, resp, resource):
+        """Stops profiling the request and writes its profile.
+
+        Args:
+            see falcon documentation.
+        """
+        profile = req.context.pop('_profile', None)
+        if profile is not None:
+            self.profiler.stop(profile, req.path if resource is not None else 'unmatched')
 
 
 class RequireAuth(object):
@@ -48,10 +175,10 @@ class RequireAuth(object):
         exempts (list): suffixes of paths which do not require authentication.
     """
 
-    exempts = ['login', 'settings']
+    exempts = ['login', 'settings', 'metrics']
 
     def process_resource(self, req, resp, resource, params):
-        """Validates the token and insert the payload into the request.
+        """Validates the token and insert the payload into the request, and the token itself as `raw_token`.
 
         Args:
             see falcon documentation.
@@ -61,9 +188,16 @@ class RequireAuth(object):
                 return
 
         try:
-            t = req.context['doc']['token'].encode('utf-8') # convert unicode to str
+            if 'doc' in req.context:
+                t = req.context['doc']['token'].encode('utf-8') # convert unicode to str
+            else:
+                # requests without a body carry the token in the Authorization header
+                scheme, _, t = (req.get_header('Authorization') or '').partition(' ')
+                if scheme.lower() != 'bearer' or not t:
+                    raise InvalidTokenError
             payload = token.verify(t)
             req.context['token'] = payload
+            req.context['raw_token'] = t
         except KeyError:
             raise InvalidTokenError
 
@@ -84,7 +218,14 @@ class RequireJSON(object):
 
 
 class JSONTranslator(object):
-    """Middleware class for converting request content into JSON and insert into request object."""
+    """Middleware class for converting request content into JSON and insert into request object.
+
+    Attributes:
+        max_body (int): bytes above which a request body is rejected unread.
+    """
+
+    def __init__(self, max_body=64 * 1024):
+        self.max_body = max_body
 
     def process_request(self, req, resp):
         """Translates the request content into JSON and insert into the request.
@@ -100,15 +241,20 @@ class JSONTranslator(object):
             # Nothing to do
             return
 
-        body = req.stream.read()
+        if req.content_length > self.max_body:
+            raise falcon.HTTPRequestEntityTooLarge('Request body too large',
+                                                   'The request body is limited to {} bytes.'.format(self.max_body))
+
+        body = req.stream.read(req.content_length)
         if not body:
             raise falcon.HTTPBadRequest('Empty request body',
                                         'A valid JSON document is required.')
 
         try:
-            req.context['doc'] = json.loads(body.decode('utf-8'))
+            # decoded from the UTF-8 bytes as they are
+            req.context['doc'] = jsoncodec.loads(body)
 
-        except (ValueError, UnicodeDecodeError):
+        except ValueError:
             raise falcon.HTTPError(falcon.HTTP_753,
                                    'Malformed JSON',
                                    'Could not decode the request body. The '
@@ -124,7 +270,7 @@ class JSONTranslator(object):
         if 'result' not in resp.context:
             return
 
-        resp.body = json.dumps(resp.context['result'])
+        resp.body = jsoncodec.dumps(resp.context['result'])
 
 def handle_vds_exception(ex, req, resp, params):
     """Handle all VDSError exceptions that are not caught.
@@ -144,6 +290,10 @@ def handle_vds_exception(ex, req, resp, params):
         raise HTTPServerError("Virtual desktop server is unable to execute certain operations")
     elif type(ex) == LdapError:
         raise HTTPServerError("Cannot connect to LDAP server")
+    elif type(ex) == BackendUnavailableError:
+        raise HTTPServerError("Backend server temporarily unavailable")
+    elif type(ex) == DeadlineExceededError:
+        raise HTTPServerError("Backend servers did not respond in time")
     else:
         log.exception(ex)
         raise HTTPServerError("Unexpected error: {}".format(ex.message))
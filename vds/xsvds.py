@@ -1,44 +1,103 @@
 import logging
-import logging.config
 import falcon
 
-from vds import api, logconf
+from vds import api, jsoncodec, logconf, metrics, preboot, resilience, token, tracing
+from vds.profiling import Profiler
 from vds.interface import xapi, ldap_ as ldap
-from vds.utils import RequireJSON, JSONTranslator, RequireAuth, Logger, handle_vds_exception
+from vds.utils import RequireJSON, JSONTranslator, RequireAuth, Logger, RequestDeadline, RequestMetrics, RequestTracing, \
+        RequestProfiler, handle_vds_exception
 from vds.exceptions import VDSError, HTTPServerError, HTTPAuthError, VDSError
 from vds.config import CONF
 
 
-logging.config.dictConfig(logconf.conf_dict)
+logconf.configure(**CONF.get('logging', {}))
 log = logging.getLogger('vds.main')
 
-# build http server
-app = falcon.API(middleware=[RequireJSON(), JSONTranslator(), Logger(), RequireAuth()])
-app.add_error_handler(VDSError, handle_vds_exception)
-
 conf_xs = CONF['xs']
 conf_ldap = CONF['ldap']
+conf_token = CONF['token']
+conf_preboot = CONF.get('preboot', {})
+conf_resilience = CONF.get('resilience', {})
+conf_metrics = CONF.get('metrics', {})
+conf_tracing = CONF.get('tracing', {})
+conf_profiling = CONF.get('profiling', {})
+conf_json = CONF.get('json', {})
+
+resilience.configure(threshold=conf_resilience.get('breaker_threshold', 5),
+        reset_timeout=conf_resilience.get('breaker_reset', 30.0))
+
+jsoncodec.configure(conf_json.get('codec', 'auto'))
+
+if conf_metrics.get('enabled', True):
+    metrics.init(directory=conf_metrics.get('directory'), interval=conf_metrics.get('interval', 10.0))
+
+middleware = [RequestMetrics(), RequestDeadline(conf_resilience.get('request_timeout', 20.0)),
+    RequireJSON(), JSONTranslator(max_body=conf_json.get('max_body', 64 * 1024)), Logger(), RequireAuth()]
+if conf_tracing.get('enabled', False):
+    tracing.init(**dict((k, v) for k, v in conf_tracing.items() if k not in ('enabled', 'header')))
+    middleware.insert(-1, RequestTracing(header=conf_tracing.get('header', False)))
+if conf_profiling.get('enabled', False):
+    api.profile.profiler = Profiler(conf_profiling.get('directory', 'profiles'),
+            every=conf_profiling.get('every', 0), max_bytes=conf_profiling.get('max_bytes', 50 * 1024 * 1024))
+    api.profile.admins = conf_profiling.get('admins', [])
+    # first, so that the other middleware is profiled too
+    middleware.insert(0, RequestProfiler(api.profile.profiler))
+
+# build http server
+app = falcon.API(middleware=middleware)
+app.add_error_handler(VDSError, handle_vds_exception)
 
 log.info("*****************************")
 log.info("*  Virtual Desktop Service  *")
 log.info("*****************************")
 app.add_route("/v1/settings", api.settings)
+app.add_route("/v1/metrics", api.metrics)
+app.add_route("/v1/admin/profile", api.profile)
 try:
+    token.init(revocation_dir=conf_token.get('revocation_dir', 'revocation'),
+            revocation_bits=conf_token.get('revocation_bits', 1 << 20))
+    log.info("Token revocations initalized.")
     # initialize xenserver & ldap
-    ldap.init(conf_ldap['ip'], conf_ldap['port'], domain=conf_ldap['domain'])
+    ldap.init(conf_ldap.get('ip'), conf_ldap.get('port'), domain=conf_ldap['domain'],
+            timeout=conf_ldap.get('timeout', 10.0), pool_size=conf_ldap.get('pool_size', 4),
+            bind_dn=conf_ldap.get('bind_dn'), bind_password=conf_ldap.get('bind_password'),
+            cache=conf_ldap.get('cache'), search_base=conf_ldap.get('search_base'),
+            attributes=conf_ldap.get('attributes'), size_limit=conf_ldap.get('size_limit', 2),
+            groups=conf_ldap.get('groups'), servers=conf_ldap.get('servers'),
+            probe_interval=conf_ldap.get('probe_interval', 30.0))
     log.info("LDAP initalized.")
-    xapi.init(conf_xs['ip'], conf_xs['username'], conf_xs['password'])
+    if 'pools' in conf_xs:
+        # options outside of `pools` are shared by all pools
+        shared = dict((k, v) for k, v in conf_xs.items() if k not in ('pools', 'timeout', 'retry_interval'))
+        xapi.init_federation([dict(shared, **pool) for pool in conf_xs['pools']],
+                timeout=conf_xs.get('timeout', 10.0), retry_interval=conf_xs.get('retry_interval', 30.0))
+    else:
+        xapi.init(conf_xs['ip'], conf_xs['username'], conf_xs['password'],
+                sessions=conf_xs.get('sessions', 4),
+                bulk_fetch=conf_xs.get('bulk_fetch', True),
+                transport=conf_xs.get('transport'),
+                inventory=conf_xs.get('inventory'),
+                scheduler=conf_xs.get('scheduler'))
     log.info("XAPI initalized.")
+    if conf_preboot.get('enabled', False):
+        preboot.init(**dict((k, v) for k, v in conf_preboot.items() if k != 'enabled'))
+        log.info("Pre-boot initalized.")
     # normal routes
     app.add_route("/v1/login", api.login)
+    app.add_route("/v1/logout", api.logout)
     app.add_route("/v1/conn", api.connect)
+    app.add_route("/v1/conn/status", api.status)
     app.add_route("/v1/heartbeat", api.heartbeat)
-except VDSError as e:
+    app.add_route("/v1/vms", api.vms)
+except (VDSError, OSError) as e:
     log.exception(e)
     # failsafe routes
     app.add_route("/v1/login", api.failsafe)
+    app.add_route("/v1/logout", api.failsafe)
     app.add_route("/v1/conn", api.failsafe)
+    app.add_route("/v1/conn/status", api.failsafe)
     app.add_route("/v1/heartbeat", api.failsafe)
+    app.add_route("/v1/vms", api.failsafe)
 
 
 